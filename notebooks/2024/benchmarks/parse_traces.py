@@ -0,0 +1,82 @@
+"""
+Benchmarks sampling the STATS outputs at every half percent:
+
+- full: every line decoded with json.loads and pushed as a dict (how the outputs
+  used to be read),
+- lazy: only search_time read from the raw lines, the picked snapshots decoded
+  with json.loads,
+- lazy + fast parser: the same with orjson/simdjson, if installed.
+
+    python parse_traces.py --problems 200 --lines 5000
+"""
+import json
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "scripts"))
+
+import generate_features_at_percent  # noqa: E402
+from generate_features_at_percent import HalfPercentSampler, open_output, sample_statistics  # noqa: E402
+from synthetic_corpus import generate_corpus  # noqa: E402
+
+
+def sample_full(path):
+    sampler = HalfPercentSampler()
+    with open(path, 'r') as stats_output:
+        for line in stats_output:
+            if line.strip():
+                sampler.push(json.loads(line).get('statistics'))
+    return sampler
+
+
+def sample_lazy(path):
+    with open_output(path) as stats_output:
+        return sample_statistics(stats_output)
+
+
+def time_sampling(function, paths, repeat):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = [function(path) for path in paths]
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark sampling the STATS outputs")
+    parser.add_argument("--corpus", type=Path, help="Existing corpus to use instead of a synthetic one")
+    parser.add_argument("--problems", type=int, default=200, help="Problems in the synthetic corpus")
+    parser.add_argument("--lines", type=int, default=5000, help="Statistics lines per synthetic STATS output")
+    parser.add_argument("--repeat", type=int, default=3, help="Best of this many runs is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        corpus = args.corpus or generate_corpus(temp_dir, args.problems, args.lines)
+        paths = sorted(corpus.glob("*-STATS.json"))
+        megabytes = sum(path.stat().st_size for path in paths) / 2 ** 20
+
+        fast_parser = generate_features_at_percent.json_loads
+        variants = [("full", sample_full, json.loads), ("lazy", sample_lazy, json.loads)]
+        if fast_parser is not json.loads:
+            variants.append((f"lazy + {fast_parser.__module__}", sample_lazy, fast_parser))
+
+        print(f"{len(paths)} STATS outputs, {megabytes:.1f} MiB")
+        baseline, expected = None, None
+        for name, function, json_loads in variants:
+            generate_features_at_percent.json_loads = json_loads
+            seconds, samplers = time_sampling(function, paths, args.repeat)
+            generate_features_at_percent.json_loads = fast_parser
+
+            sampled = [(sampler.statistics_per_half_percent, sampler.final_statistic) for sampler in samplers]
+            if expected is None:
+                baseline, expected = seconds, sampled
+            assert sampled == expected, f"{name} sampled different snapshots"
+            print(f"{name:>20}: {seconds:7.3f}s  {megabytes / seconds:7.1f} MiB/s  {baseline / seconds:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Benchmarks the stages of the feature pipeline on a synthetic corpus (see
+synthetic_corpus.py) and records the results in a JSON file, so regressions in
+the hot paths show up without a run on the full dataset.
+
+Every stage is timed (wall and CPU time of this process) and, unless
+--no_memory, run a second time under tracemalloc for its peak memory:
+
+    snapshot_lookup            lookup of all half percents in full STATS traces
+    load_to_dataframe          parsing and sampling the NORMAL/STATS outputs
+    create_features_at_percent deriving the features and gradients
+    save_features              writing the feature store
+    load_features              reading the feature store
+    cross_validate             a DT and an RF target on one percentage
+
+    python run.py --problems 200 --lines 2000 --output results.json --compare previous.json
+"""
+import datetime
+import gc
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "scripts"))
+
+import logging  # noqa: E402
+
+import cross_validate  # noqa: E402
+import generate_features_at_percent  # noqa: E402
+from feature_store import load_features, save_features  # noqa: E402
+from synthetic_corpus import STATISTICS_KEYS, generate_corpus  # noqa: E402
+
+CROSS_VALIDATION_TARGETS = [
+    {"model": "DT", "hyperparameters": {"max_depth": 10}},
+    {"model": "RF", "hyperparameters": {"n_estimators": 20}},
+]
+
+
+def stage_snapshot_lookup(context):
+    statistics = []
+    for path in context["stats_paths"][:context["lookup_files"]]:
+        with open(path) as f:
+            trace = [json.loads(line).get('statistics') for line in f if line.strip()]
+        statistics.append([statistic for statistic in trace if statistic is not None])
+    times = generate_features_at_percent.HalfPercentSampler().time_at_percent(np.arange(1, 200))
+
+    def run():
+        for trace in statistics:
+            search_time = np.fromiter((statistic['search_time'] for statistic in trace), dtype=float, count=len(trace))
+            generate_features_at_percent.find_indices_at_percent(search_time, times)
+    return run, len(statistics)
+
+
+def stage_load_to_dataframe(context):
+    def run():
+        context["df"] = generate_features_at_percent.load_to_dataframe(context["corpus"], context["num_processes"])
+    return run, len(context["stats_paths"])
+
+
+def stage_create_features_at_percent(context):
+    def run():
+        context["features"] = generate_features_at_percent.create_features_at_percent(context["df"], lag=1)
+    return run, len(context["df"])
+
+
+def stage_save_features(context):
+    def run():
+        save_features(context["features"], context["store"])
+    return run, sum(len(df) for df in context["features"].values())
+
+
+def stage_load_features(context):
+    def run():
+        context["loaded"] = load_features(context["store"])
+    return run, sum(len(df) for df in context["features"].values())
+
+
+def stage_cross_validate(context):
+    percentage = context["percentage"]
+    targets = [dict(target, percentage=percentage, use_gradient=True, use_ewma=True,
+                    k_fold={"n_splits": 5, "random_state": 0},
+                    preprocessing={"scale": True, "drop_constant_values": True})
+               for target in CROSS_VALIDATION_TARGETS]
+
+    def run():
+        data_at_percentage, _ = cross_validate.prepare_view(targets[0], context["loaded"])
+        folds = cross_validate.prepare_folds(targets[0], data_at_percentage)
+        for target in targets:
+            cross_validate.cross_validate(target, folds)
+    return run, len(context["loaded"][percentage])
+
+
+STAGES = {
+    "snapshot_lookup": stage_snapshot_lookup,
+    "load_to_dataframe": stage_load_to_dataframe,
+    "create_features_at_percent": stage_create_features_at_percent,
+    "save_features": stage_save_features,
+    "load_features": stage_load_features,
+    "cross_validate": stage_cross_validate,
+}
+
+
+def measure(run, items, memory=True):
+    gc.collect()
+    wall, cpu = time.perf_counter(), time.process_time()
+    run()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    result = {"seconds": wall, "cpu_seconds": cpu, "items": items, "items_per_second": items / wall if wall else None}
+    if memory:
+        # A second run, since tracemalloc slows down the allocations it traces
+        gc.collect()
+        tracemalloc.start()
+        run()
+        result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_path):
+    previous = json.loads(Path(previous_path).read_text())["stages"]
+    print(f"\nCompared to {previous_path}:")
+    for stage, result in results["stages"].items():
+        if stage in previous:
+            print(f"{stage:>28}: {result['seconds'] / previous[stage]['seconds']:5.2f}x time")
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the feature pipeline on a synthetic corpus")
+    parser.add_argument("--problems", type=int, default=200, help="Problems in the synthetic corpus")
+    parser.add_argument("--lines", type=int, default=2000, help="Statistics lines per STATS output")
+    parser.add_argument("--extra_keys", type=int, default=0,
+                        help="Extra statistics keys per line, to measure wider traces (the pipeline "
+                             "only uses snapshots with the modded chuffed keys)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the corpus")
+    parser.add_argument("--num_processes", type=int, default=1,
+                        help="Processes for load_to_dataframe (CPU time only counts this process)")
+    parser.add_argument("--lookup_files", type=int, default=20,
+                        help="STATS outputs to benchmark the snapshot lookup on")
+    parser.add_argument("--percentage", type=int, default=20, help="Percentage to cross validate on")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES),
+                        help="Stages to run (later stages need the earlier ones)")
+    parser.add_argument("--no_memory", action="store_true", help="Skip the tracemalloc runs")
+    parser.add_argument("--output", type=Path, help="JSON file to write the results to")
+    parser.add_argument("--compare", type=Path, help="Earlier results (with the same parameters) to compare against")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    keys = STATISTICS_KEYS + [f"extra_{i}" for i in range(args.extra_keys)]
+    results = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "stages": {},
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start = time.perf_counter()
+        corpus = generate_corpus(Path(temp_dir) / "corpus", args.problems, args.lines, args.seed, keys)
+        print(f"Generated {args.problems} problems in {time.perf_counter() - start:.1f}s")
+
+        context = {
+            "corpus": corpus,
+            "stats_paths": sorted(corpus.glob("*-STATS.json")),
+            "store": Path(temp_dir) / "features_at_percentiles",
+            "num_processes": args.num_processes,
+            "lookup_files": args.lookup_files,
+            "percentage": args.percentage,
+        }
+        for stage in args.stages:
+            run, items = STAGES[stage](context)
+            results["stages"][stage] = result = measure(run, items, not args.no_memory)
+            memory = f"{result['peak_memory_mb']:8.1f} MiB peak" if "peak_memory_mb" in result else ""
+            print(f"{stage:>28}: {result['seconds']:8.3f}s  {result['cpu_seconds']:8.3f}s CPU  {memory}")
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(results, indent=4))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
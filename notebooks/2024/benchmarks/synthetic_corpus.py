@@ -0,0 +1,82 @@
+"""
+Generates a synthetic corpus of solver outputs in the layout of
+resources/problem_output, for benchmarking the feature pipeline without running
+the solvers:
+
+    PROB-p<class>-MZN-m<model>-DZN-d<instance>-OUTPUT-NORMAL.json
+    PROB-p<class>-MZN-m<model>-DZN-d<instance>-OUTPUT-STATS.json
+
+NORMAL outputs hold a single solution line with the wall time, STATS outputs a
+json-stream of modded chuffed statistics lines (with some solution lines mixed
+in) until a random end time. Extra statistics keys make the lines wider.
+
+    python synthetic_corpus.py OUTPUT_DIR --problems 200 --lines 2000
+"""
+import json
+import random
+from argparse import ArgumentParser
+from pathlib import Path
+
+TIME_LIMIT = 7200  # seconds
+
+# The statistics printed by modded chuffed
+STATISTICS_KEYS = ['conflicts', 'ewma_conflicts', 'decisions', 'search_iterations', 'opennodes', 'ewma_opennodes',
+                   'vars', 'back_jumps', 'ewma_back_jumps', 'solutions', 'total_time', 'intVars', 'search_time',
+                   'propagations', 'sat_propagations', 'ewma_propagations', 'propagators', 'boolVars', 'learnt',
+                   'bin', 'tern', 'long', 'peak_depth', 'decision_level_engine', 'ewma_decision_level_engine',
+                   'decision_level_treesize', 'clause_mem', 'prop_mem', 'best_objective', 'ewma_best_objective',
+                   'decision_level_sat', 'ewma_decision_level_mip', 'decision_level_mip']
+CONSTANT_KEYS = ('vars', 'boolVars', 'intVars', 'propagators')
+
+
+def write_problem(output_dir: Path, index, lines, rng: random.Random, keys=STATISTICS_KEYS):
+    name = f"PROB-p{index % 7}-MZN-m{index % 11}-DZN-d{index}-OUTPUT"
+
+    # A third of the problems times out, a few are too fast to be used
+    normal_time = rng.choice([rng.uniform(11, TIME_LIMIT - 1), TIME_LIMIT, rng.uniform(11, 600), rng.uniform(1, 9)])
+    with open(output_dir / f"{name}-NORMAL.json", "w") as f:
+        f.write(json.dumps({"type": "solution", "output": {}, "time": normal_time * 1000}) + "\n")
+
+    end = rng.uniform(50, TIME_LIMIT)
+    statistics = {key: 0 for key in keys}
+    statistics.update(vars=rng.randint(1, 5000), intVars=rng.randint(0, 500), propagators=rng.randint(1, 5000))
+    statistics['boolVars'] = rng.randint(0, statistics['vars'])
+
+    search_time = 0.0
+    with open(output_dir / f"{name}-STATS.json", "w") as f:
+        for _ in range(lines):
+            search_time += rng.expovariate(lines / end)
+            for key in keys:
+                if key not in CONSTANT_KEYS and rng.random() < 0.9:
+                    statistics[key] += rng.randint(0, 50)
+            statistics['search_time'] = search_time
+            statistics['ewma_conflicts'] = rng.random()
+            if rng.random() < 0.02:
+                f.write(json.dumps({"type": "solution", "output": {}, "time": search_time}) + "\n")
+            f.write(json.dumps({"type": "statistics", "statistics": statistics}) + "\n")
+
+
+def generate_corpus(output_dir, problems=200, lines=2000, seed=0, keys=STATISTICS_KEYS):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    for index in range(problems):
+        write_problem(output_dir, index, lines, rng, keys)
+    return output_dir
+
+
+def main():
+    parser = ArgumentParser(description="Generate a synthetic corpus of solver outputs")
+    parser.add_argument("output_dir", type=Path, help="Directory to write the outputs to")
+    parser.add_argument("--problems", type=int, default=200, help="Number of problems")
+    parser.add_argument("--lines", type=int, default=2000, help="Statistics lines per STATS output")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--extra_keys", type=int, default=0, help="Extra statistics keys per line")
+    args = parser.parse_args()
+
+    keys = STATISTICS_KEYS + [f"extra_{i}" for i in range(args.extra_keys)]
+    generate_corpus(args.output_dir, args.problems, args.lines, args.seed, keys)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
+python scripts/generate_pickles_for_problem_class_ablation.py --input ./analysis/paper-data/all_features.pkl --output analysis/paper-data/ablation-problem-class-halved-{seed} --random 601 602 603 604 605 606 607 608 609 6010;
 for i in 1 2 3 4 5 6 7 8 9 10;
-  python scripts/generate_pickles_for_problem_class_ablation.py --input ./analysis/paper-data/all_features.pkl --output analysis/paper-data/ablation-problem-class-halved-$i.pkl --random 60$i;
-  # python scripts/cross_validate.py --target analysis/paper-data/targets_full --pickle analysis/paper-data/ablation-problem-class-$i.pkl_train.pkl --output analysis/paper-data/cross-validations-ablation-problem-class-$i;
+  # python scripts/cross_validate.py --target analysis/paper-data/targets_full --pickle analysis/paper-data/ablation-problem-class-60{$i}_train.npz --output analysis/paper-data/cross-validations-ablation-problem-class-$i --results analysis/paper-data/results.sqlite --experiment ablation-problem-class --run $i --seed 60{$i};
 end;
-
@@ -1,14 +1,19 @@
 import warnings
 
 import collections
+import contextlib
+import copy
 import json
 import logging
 import multiprocessing
 import pickle
+import tempfile
+import time
 from argparse import ArgumentParser
 from pathlib import Path
 
 import functools
+import numpy as np
 import pandas as pd
 from rich import progress
 from rich.logging import RichHandler
@@ -24,6 +29,11 @@ from sklearn.preprocessing import MaxAbsScaler
 from sklearn.svm import SVC
 from sklearn.tree import DecisionTreeClassifier
 
+from feature_store import MappedFeatures, SplitFeatures, is_pickle, is_split, load_features, read_split, write_feature_store
+from instrumentation import Instrumentation
+from results_db import ResultsDatabase
+from run_ledger import RunLedger, target_hash
+
 def warn(*args, **kwargs):
     pass
 
@@ -39,6 +49,9 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
 
+# Ensembles whose n_estimators can be swept by growing a single model
+SWEEP_MODELS = ('RF', 'ET', 'AdaBoost')
+
 
 def create_model(model, hyperparameters):
     if model == 'LR':
@@ -71,6 +84,7 @@ def preprocessing(dataframe, target):
     if len(dataframe) == 0:
         raise ValueError("No more points for current percentage.")
 
+    transformer = None
     if target['preprocessing']['scale']:
         transformer = MaxAbsScaler().fit(result)
         result = pd.DataFrame(transformer.transform(result), columns=result.columns,
@@ -78,10 +92,22 @@ def preprocessing(dataframe, target):
 
     result['mzn'] = mzn
 
-    return result
+    return result, transformer
+
+
+def view_key(target):
+    """
+    Targets with the same key cross validate on the same data view and folds.
+    """
+    return (target['percentage'], target['use_gradient'], target['use_ewma'],
+            json.dumps(target['preprocessing'], sort_keys=True), json.dumps(target['k_fold'], sort_keys=True))
 
 
-def cross_validate(target, train_data):
+def prepare_view(target, train_data):
+    """
+    Filters and preprocesses the data at the target's percentage. Returns the view
+    and the scaler fitted on it (None if the target does not scale).
+    """
     percentage = target['percentage']
     data_at_percentage: pd.DataFrame = train_data[percentage]
 
@@ -99,16 +125,17 @@ def cross_validate(target, train_data):
         if 'has_gradients' in data_at_percentage.columns:
             data_at_percentage = data_at_percentage[data_at_percentage['has_gradients']]
 
-    data_at_percentage = preprocessing(data_at_percentage, target)
+    return preprocessing(data_at_percentage, target)
 
-    model = create_model(target['model'], target['hyperparameters'])
-    
-    # K-fold
-    stratified_k_fold = StratifiedKFold(n_splits=target['k_fold']['n_splits'], shuffle=True)
 
-    f1_scores = []
-    f1_scores_per_problem = collections.defaultdict(list)
+def prepare_folds(target, data_at_percentage):
+    """
+    Splits a prepared view into the stratified folds, ready to fit and score on.
+    """
+    stratified_k_fold = StratifiedKFold(n_splits=target['k_fold']['n_splits'], shuffle=True,
+                                        random_state=target['k_fold'].get('random_state'))
 
+    folds = []
     for train, test in stratified_k_fold.split(
             data_at_percentage.drop(columns=["solved_within_time_limit"]),
             data_at_percentage["solved_within_time_limit"]
@@ -119,53 +146,135 @@ def cross_validate(target, train_data):
         train_x, train_y = train_data.drop(columns=["solved_within_time_limit"]), train_data["solved_within_time_limit"]
         test_x, test_y = test_data.drop(columns=["solved_within_time_limit"]), test_data["solved_within_time_limit"]
 
-        train_x = train_x.drop(['mzn'], axis=1)
-        model = model.fit(train_x, train_y)
+        problem_codes, problems = pd.factorize(test_x['mzn'])
+        folds.append(dict(
+            index=len(folds),
+            train_x=train_x.drop(['mzn'], axis=1),
+            train_y=train_y,
+            test_x=test_x.drop(['mzn'], axis=1),
+            test_y=test_y,
+            problems=problems,
+            problem_codes=problem_codes,
+            problem_lengths=np.bincount(problem_codes, minlength=len(problems)),
+        ))
 
-        test_x, mzn = test_x.drop(["mzn"], axis=1), test_x["mzn"]
-        predictions = model.predict(test_x)
-        current_f1_score = f1_score(test_y, predictions)
-        f1_scores.append(current_f1_score)
+    return folds
 
-        test_x['mzn'] = mzn
-        test_x['gt'] = test_y
-        test_x['predictions'] = predictions
-        for problem in set(test_x['mzn'].values):
-            data_for_problem = test_x[test_x['mzn'] == problem]
-            amount_of_points = len(data_for_problem)
 
-            gt, predictions = data_for_problem['gt'], data_for_problem['predictions']
+def score_fold(fold, predictions, percentage, f1_scores, f1_scores_per_problem):
+    current_f1_score = f1_score(fold['test_y'], predictions)
+    f1_scores.append(current_f1_score)
 
-            vc = ((gt == predictions).value_counts(normalize=True).to_dict())
+    # Fraction of correct predictions per problem, in one pass over the fold
+    correct = np.bincount(fold['problem_codes'], weights=fold['test_y'].to_numpy() == predictions,
+                          minlength=len(fold['problems'])) / fold['problem_lengths']
 
-            correct = 0 if True not in vc else vc[True]
+    for problem, amount_of_points, fraction_correct in zip(fold['problems'], fold['problem_lengths'], correct):
+        # A problem is only in the folds it has test rows in, so its entries carry their fold
+        f1_scores_per_problem[problem].append({
+            'fold': fold['index'],
+            'length': int(amount_of_points),
+            'percentage': percentage,
+            'correct': float(fraction_correct)
+        })
 
-            f1_scores_per_problem[problem].append({
-                'length': amount_of_points,
-                'percentage': percentage,
-                'correct': correct
-            })
+
+def cross_validate(target, folds):
+    percentage = target['percentage']
+    model = create_model(target['model'], target['hyperparameters'])
+
+    f1_scores = []
+    f1_scores_per_problem = collections.defaultdict(list)
+
+    for fold in folds:
+        model = model.fit(fold['train_x'], fold['train_y'])
+        score_fold(fold, model.predict(fold['test_x']), percentage, f1_scores, f1_scores_per_problem)
 
     return model, dict(hyperparameters=target['hyperparameters'],
                        f1_scores=f1_scores,
                        per_problem=dict(f1_scores_per_problem)),
 
 
-def run_per_target(target_path, output_path, train_data):
-    if output_path.joinpath(target_path.stem).with_suffix(".json").exists():
-        logger.info(f"{output_path.joinpath(target_path.stem).with_suffix('.json')} exists. Skipping.")
-        return
+def sweep_key(target):
+    """
+    Targets with the same sweep key only differ in the size of their ensemble.
+    """
+    if target['model'] not in SWEEP_MODELS or 'n_estimators' not in target['hyperparameters']:
+        return None
+    others = {key: value for key, value in target['hyperparameters'].items() if key != 'n_estimators'}
+    return target['model'], json.dumps(others, sort_keys=True)
 
 
-    logger.info(f"Loading {target_path}")
-    target = json.loads(target_path.read_text())
-    try:
-        model, result = cross_validate(target, train_data)
-        result['original_target'] = str(target_path)
-    except ValueError as e:
-        logger.error(f"Error: {e}")
-        return
+def truncate_ensemble(model, n_estimators):
+    """
+    Copy of a fitted ensemble that only keeps its first n_estimators members, which
+    is the model a warm start (or boosting) had at that size.
+    """
+    truncated = copy.copy(model)
+    truncated.n_estimators = n_estimators
+    truncated.estimators_ = list(model.estimators_[:n_estimators])
+    if isinstance(model, AdaBoostClassifier):
+        truncated.estimator_weights_ = model.estimator_weights_[:n_estimators].copy()
+        truncated.estimator_errors_ = model.estimator_errors_[:n_estimators].copy()
+    return truncated
 
+
+def cross_validate_sweep(targets, folds):
+    """
+    Cross validates targets that only differ in n_estimators (see sweep_key) by
+    growing one ensemble per fold and scoring it at every requested size. Forests
+    are grown with warm_start, AdaBoost is fit once at the largest size and scored
+    through staged_predict. Returns (target_path, model, result) per target.
+    """
+    first = targets[0][1]
+    percentage = first['percentage']
+    sizes = sorted({target['hyperparameters']['n_estimators'] for _, target in targets})
+    hyperparameters = dict(first['hyperparameters'], n_estimators=sizes[0])
+
+    f1_scores = {size: [] for size in sizes}
+    f1_scores_per_problem = {size: collections.defaultdict(list) for size in sizes}
+
+    model = None
+    for fold in folds:
+        model = create_model(first['model'], hyperparameters)
+
+        if isinstance(model, AdaBoostClassifier):
+            model.set_params(n_estimators=sizes[-1]).fit(fold['train_x'], fold['train_y'])
+            # Boosting may stop early, in which case the larger sizes get the last stage
+            stages = list(model.staged_predict(fold['test_x']))
+            for size in sizes:
+                score_fold(fold, stages[min(size, len(stages)) - 1], percentage,
+                           f1_scores[size], f1_scores_per_problem[size])
+        else:
+            model.set_params(warm_start=True)
+            for size in sizes:
+                with warnings.catch_warnings():
+                    # Balanced class weights are fine here, every size is fit on the same fold
+                    warnings.simplefilter("ignore", UserWarning)
+                    model.set_params(n_estimators=size).fit(fold['train_x'], fold['train_y'])
+                score_fold(fold, model.predict(fold['test_x']), percentage,
+                           f1_scores[size], f1_scores_per_problem[size])
+
+    results = []
+    for target_path, target in targets:
+        size = target['hyperparameters']['n_estimators']
+        results.append((target_path, truncate_ensemble(model, size), dict(
+            hyperparameters=target['hyperparameters'],
+            f1_scores=f1_scores[size],
+            per_problem=dict(f1_scores_per_problem[size]),
+        )))
+    return results
+
+
+def is_done(target_path, output_path):
+    result_path = output_path.joinpath(target_path.stem).joinpath("data.json")
+    if result_path.exists():
+        logger.info("%s exists. Skipping.", result_path)
+        return True
+    return False
+
+
+def save_result(target_path, output_path, model, result, scaler=None):
     model_path = output_path.joinpath(target_path.stem).joinpath("./model").with_suffix(".pkl")
     model_path.parent.mkdir(parents=True, exist_ok=True)
     result_path = output_path.joinpath(target_path.stem).joinpath("./data").with_suffix(".json")
@@ -176,9 +285,125 @@ def run_per_target(target_path, output_path, train_data):
     with model_path.open('wb') as f:
         pickle.dump(model, f)
 
+    # The model only applies to features scaled the same way, e.g. by predict_online.py
+    if scaler is not None:
+        scaler_path = model_path.with_name("scaler.pkl")
+        result['scaler_path'] = str(scaler_path)
+        with scaler_path.open('wb') as f:
+            pickle.dump(scaler, f)
+
     result_path.write_text(json.dumps(result))
 
-    logger.info(f"Logged output to {str(result_path)}")
+    logger.info("Logged output to %s", result_path)
+    return result_path, model_path
+
+
+def group_targets(target_paths):
+    """
+    Reads the targets and groups them by the data view they cross validate on (see
+    view_key), so each view is filtered, preprocessed and split into folds once for
+    all of its models. Groups are sorted by view, so by percentage first.
+    """
+    views = collections.defaultdict(list)
+    for target_path in sorted(target_paths):
+        target = json.loads(Path(target_path).read_text())
+        views[view_key(target)].append((target_path, target))
+    return [views[key] for key in sorted(views)]
+
+
+def view_chunksize(views, processes=None):
+    """
+    The chunksize to hand views to a pool with. Views are sorted by percentage (see
+    group_targets), so a chunk of consecutive views lets a worker keep reusing the
+    percentage it has read; every worker still gets a few chunks, as views take
+    uneven time.
+    """
+    return max(1, len(views) // ((processes or multiprocessing.cpu_count()) * 4))
+
+
+def pending_views(views, output_path, ledger):
+    """
+    Drops the targets the ledger has as done from the views (and views left
+    empty). Targets done before there was a ledger (the ledger has no row for
+    them at all) are found by is_done and recorded, so the next run finds them
+    in the ledger too. A target the ledger has with other contents is run again.
+    Returns the pending views and the number of targets skipped.
+    """
+    pending, skipped, found = [], 0, []
+    for view in views:
+        targets = []
+        for target_path, target in view:
+            key = target_hash(target_path, target)
+            if ledger.is_done(key):
+                skipped += 1
+            elif not ledger.has_target(target_path) and is_done(target_path, output_path):
+                skipped += 1
+                found.append(dict(target_hash=key, target_path=str(target_path), status="done",
+                                  result_path=str(output_path.joinpath(target_path.stem, "data.json")),
+                                  model_path=str(output_path.joinpath(target_path.stem, "model.pkl"))))
+            else:
+                targets.append((target_path, target))
+        if targets:
+            pending.append(targets)
+    if found:
+        ledger.record(found)
+    return pending, skipped
+
+
+def run_per_view(targets, output_path, train_data, warm_start_sweep=False):
+    """
+    Cross validates a group of targets that share a view (see view_key). The view
+    and its folds are prepared once, then every model of the group runs on them.
+    With warm_start_sweep, ensembles that only differ in size are trained as one
+    sweep (see cross_validate_sweep). Returns a ledger record per target (see
+    run_ledger.py), for the main process to record; those of done targets also
+    carry the target and its result for the results database (see results_db.py).
+    """
+    started = time.time()
+    records = []
+
+    def failed(sweep, error):
+        logger.error("Error: %s", error)
+        records.extend(dict(target_hash=target_hash(target_path, target), target_path=str(target_path),
+                            status="failed", started=started, error=str(error))
+                       for target_path, target in sweep)
+
+    try:
+        data_at_percentage, scaler = prepare_view(targets[0][1], train_data)
+        folds = prepare_folds(targets[0][1], data_at_percentage)
+    except ValueError as e:
+        failed(targets, e)
+        return records
+
+    sweeps = collections.defaultdict(list)
+    for target_path, target in targets:
+        key = sweep_key(target) if warm_start_sweep else None
+        sweeps[key if key is not None else target_path].append((target_path, target))
+
+    for sweep in sweeps.values():
+        started = time.time()
+        try:
+            if len(sweep) > 1:
+                results = cross_validate_sweep(sweep, folds)
+            else:
+                target_path, target = sweep[0]
+                results = [(target_path, *cross_validate(target, folds))]
+        except ValueError as e:
+            failed(sweep, e)
+            continue
+        seconds = time.time() - started
+
+        for (target_path, target), (_, model, result) in zip(sweep, results):
+            result['original_target'] = str(target_path)
+            result_path, model_path = save_result(target_path, output_path, model, result, scaler)
+            records.append(dict(target_hash=target_hash(target_path, target), target_path=str(target_path),
+                                status="done", started=started, seconds=seconds,
+                                result_path=str(result_path), model_path=str(model_path),
+                                target=target, result=result))
+
+    return records
+
+
 def main():
     """
     Runs cross validation.
@@ -194,7 +419,7 @@ def main():
         "--pickle",
         type=str,
         required=True,
-        help="Path to training data pickle",
+        help="Path to training data feature store (or pickle), or the split manifest of the training data",
     )
     parser.add_argument(
         "--output",
@@ -202,6 +427,43 @@ def main():
         help="Path to output directory",
     )
 
+    parser.add_argument(
+        "--results",
+        type=str,
+        help="Results database to record the results in (default: results.sqlite in the output directory)",
+    )
+    parser.add_argument(
+        "--experiment",
+        type=str,
+        required=True,
+        help="Name of the experiment in the results database, e.g. base-experiment (what the analysis "
+             "notebooks filter on)",
+    )
+    parser.add_argument(
+        "--run",
+        type=int,
+        required=True,
+        help="Run of the experiment in the results database",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Random seed of the train/test split, for the results database",
+    )
+
+    parser.add_argument(
+        "--warm_start_sweep",
+        action="store_true",
+        help="Grow one RF/ET/AdaBoost ensemble per fold for all n_estimators of a "
+             "hyperparameter combination instead of training each size from scratch",
+    )
+
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="JSON file to write the time, CPU time, peak memory and throughput of every stage to",
+    )
+
     args = parser.parse_args()
 
     target_dir_path = Path(args.target)
@@ -209,21 +471,59 @@ def main():
     output_path = Path(args.output)
 
     output_path.mkdir(parents=True, exist_ok=True)
-    logger.debug(f"Created output directory {output_path}")
-
-    train_data: dict[int, pd.DataFrame] = pickle.loads(features_at_percent_path.read_bytes())
+    logger.debug("Created output directory %s", output_path)
+    instrumentation = Instrumentation("cross_validate")
 
     targets = list(target_dir_path.glob("*.json"))
+    ledger = RunLedger(output_path)
+    results = ResultsDatabase(args.results or output_path / "results.sqlite")
+    views, skipped = pending_views(group_targets(targets), output_path, ledger)
+    logger.info("Skipping %d targets that are done", skipped)
+    if not views:
+        ledger.close()
+        results.close()
+        return
 
-    with multiprocessing.Pool() as pool:
-        with progress.Progress(expand=True) as pbar:
-            task = pbar.add_task("[red]Cross validating...", total=len(targets))
-            for _ in pool.imap(functools.partial(
-                    run_per_target,
-                    output_path=output_path,
-                    train_data=train_data
-            ), targets):
-                pbar.advance(task)
+    # Workers share the training data through the memory-mapped feature store and only
+    # get its path with every view. A pickle is spilled to a temporary store first, and
+    # a split manifest is a view of the rows of its split in the store it points into.
+    with contextlib.ExitStack() as stack:
+        with instrumentation.stage("prepare_training_data") as stage:
+            split = None
+            if is_split(features_at_percent_path):
+                features_at_percent_path, *split = read_split(features_at_percent_path)
+
+            if is_pickle(features_at_percent_path) or features_at_percent_path.is_file():
+                store_path = Path(stack.enter_context(tempfile.TemporaryDirectory(dir=output_path)))
+                percentages = sorted({view[0][1]['percentage'] for view in views})
+                write_feature_store(load_features(features_at_percent_path, percentages=percentages), store_path,
+                                    downcast=False)
+            else:
+                store_path = features_at_percent_path
+            train_data = MappedFeatures(store_path)
+            if split is not None:
+                train_data = SplitFeatures(train_data, *split)
+            stage.count(percentages=len(train_data))
+
+        with instrumentation.stage("cross_validate", targets=len(targets) - skipped, views=len(views)):
+            with multiprocessing.Pool() as pool:
+                with progress.Progress(expand=True) as pbar:
+                    task = pbar.add_task("[red]Cross validating...", total=len(targets), completed=skipped)
+                    for records in pool.imap_unordered(functools.partial(
+                            run_per_view,
+                            output_path=output_path,
+                            train_data=train_data,
+                            warm_start_sweep=args.warm_start_sweep,
+                    ), views, chunksize=view_chunksize(views)):
+                        ledger.record(records)
+                        results.record([record for record in records if record["status"] == "done"],
+                                       args.experiment, args.run, args.seed)
+                        pbar.advance(task, len(records))
+    ledger.close()
+    results.close()
+
+    if args.report:
+        instrumentation.write_report(args.report)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,336 @@
+"""
+Columnar on-disk store for the features at percent.
+
+A store is a directory with a manifest and one sub-directory per percentage.
+Each percentage holds its row index and one column-major matrix per column
+type, so every column is a contiguous slice of its file:
+
+    features_at_percentiles/
+        manifest.json       column names per percentage, string categories
+        1/index.npy         int64 row index
+        1/numeric.npy       float32, rows x numeric columns
+        1/boolean.npy       bool, rows x boolean columns
+        1/categorical.npy   int32 codes into the categories (mzn, dzn)
+        ...
+
+A percentage (or a subset of its columns) is memory-mapped without reading the
+rest of the store. Paths ending in .pkl/.pickle are read and written as the
+pickled dict[int, DataFrame] the pipeline used before.
+
+Train/test splits are not copies of the features but split manifests (.npz):
+the row positions per percentage into the store (or pickle) they were made
+from, see save_split. Loading a manifest slices those rows on the fly.
+"""
+import functools
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+MANIFEST = "manifest.json"
+PICKLE_SUFFIXES = (".pkl", ".pickle")
+SPLIT_SUFFIX = ".npz"
+# The columns identifying the problem of a row, see fingerprint
+FINGERPRINT_COLUMNS = ["mzn", "dzn"]
+COLUMN_TYPES = ("numeric", "boolean", "categorical")
+
+
+def is_pickle(path) -> bool:
+    return Path(path).suffix in PICKLE_SUFFIXES
+
+
+def is_split(path) -> bool:
+    return Path(path).suffix == SPLIT_SUFFIX
+
+
+def select_columns(columns, use_ewma=True, use_gradient=True) -> list[str]:
+    """
+    Same column filtering as the cross validation: drops the ewma and/or gradient
+    columns (the latter includes has_gradients).
+    """
+    columns = list(columns)
+    if not use_ewma:
+        columns = [column for column in columns if "ewma" not in column]
+    if not use_gradient:
+        columns = [column for column in columns if "gradient" not in column]
+    return columns
+
+
+def _column_type(values: pd.Series) -> str:
+    if pd.api.types.is_bool_dtype(values):
+        return "boolean"
+    if pd.api.types.is_numeric_dtype(values):
+        return "numeric"
+    return "categorical"
+
+
+def write_feature_store(features_at_percent: dict[int, pd.DataFrame], path, downcast=True):
+    """
+    Writes a dict of DataFrames keyed by percentage to a store at path. With
+    downcast=False numeric columns keep float64 precision.
+
+    The store is written to a sibling directory and swapped in once complete, so
+    a store being regenerated (e.g. incrementally, over its previous version) is
+    never left half written. Readers that have mapped the previous version keep
+    reading it.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    staging = path.with_name(f".{path.name}.{os.getpid()}")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+    try:
+        _write_store(features_at_percent, staging, downcast)
+        if path.exists():
+            previous = staging.with_name(staging.name + ".previous")
+            path.rename(previous)
+            staging.rename(path)
+            shutil.rmtree(previous)
+        else:
+            staging.rename(path)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def _write_store(features_at_percent: dict[int, pd.DataFrame], path: Path, downcast: bool):
+    manifest = {"percentages": {}, "categories": {}}
+    categories: dict[str, dict[str, int]] = {}
+
+    for percentage, df in features_at_percent.items():
+        percentage_dir = path / str(percentage)
+        percentage_dir.mkdir(exist_ok=True)
+        np.save(percentage_dir / "index.npy", df.index.to_numpy(dtype=np.int64))
+
+        columns = {column_type: [] for column_type in COLUMN_TYPES}
+        for column in df.columns:
+            columns[_column_type(df[column])].append(column)
+
+        numeric = df[columns["numeric"]].to_numpy(dtype=np.float32 if downcast else np.float64)
+        np.save(percentage_dir / "numeric.npy", np.asfortranarray(numeric))
+        np.save(percentage_dir / "boolean.npy", np.asfortranarray(df[columns["boolean"]].to_numpy(dtype=bool)))
+
+        codes = np.empty((len(df), len(columns["categorical"])), dtype=np.int32, order="F")
+        for position, column in enumerate(columns["categorical"]):
+            column_categories = categories.setdefault(column, {})
+            codes[:, position] = [column_categories.setdefault(value, len(column_categories))
+                                  for value in df[column].astype(str)]
+        np.save(percentage_dir / "categorical.npy", codes)
+
+        manifest["percentages"][str(percentage)] = {"rows": len(df), "columns": columns,
+                                                    "order": list(map(str, df.columns))}
+
+    manifest["categories"] = {column: list(values) for column, values in categories.items()}
+    (path / MANIFEST).write_text(json.dumps(manifest))
+
+
+def read_manifest(path) -> dict:
+    return json.loads((Path(path) / MANIFEST).read_text())
+
+
+def store_percentages(path) -> list[int]:
+    return [int(percentage) for percentage in read_manifest(path)["percentages"]]
+
+
+def read_percentage(path, percentage: int, columns=None, use_ewma=True, use_gradient=True,
+                    manifest=None, mapped=False) -> pd.DataFrame:
+    """
+    Reads a single percentage from the store. Only the requested columns (all by
+    default, minus ewma/gradient columns if disabled) are read from disk.
+
+    With mapped, the numeric and boolean columns are read-only views of the
+    memory-mapped files (one unconsolidated block per column, since consolidating
+    copies), so processes mapping the same percentage share its pages. Only the
+    categorical columns are decoded into memory.
+    """
+    path = Path(path)
+    manifest = manifest or read_manifest(path)
+    stored = manifest["percentages"][str(percentage)]
+
+    if columns is None:
+        columns = stored["order"]
+    columns = select_columns([column for column in columns if column in stored["order"]], use_ewma, use_gradient)
+
+    percentage_dir = path / str(percentage)
+    index = np.load(percentage_dir / "index.npy")
+    values = {}
+    for column_type in COLUMN_TYPES:
+        positions = {column: position for position, column in enumerate(stored["columns"][column_type])
+                     if column in columns}
+        if not positions:
+            continue
+
+        # Matrices are column-major, so every column is a contiguous view of the mapped file
+        matrix = np.load(percentage_dir / f"{column_type}.npy", mmap_mode="r")
+        for column, position in positions.items():
+            if column_type == "categorical":
+                values[column] = np.asarray(manifest["categories"][column], dtype=object)[matrix[:, position]]
+            else:
+                values[column] = np.asarray(matrix[:, position])
+
+    return pd.DataFrame({column: values[column] for column in columns}, index=index, copy=not mapped)
+
+
+def load_features(path, percentages=None, columns=None, use_ewma=True, use_gradient=True) -> dict[int, pd.DataFrame]:
+    """
+    Loads features at percent from a store directory, a pickle or a split
+    manifest, optionally restricted to some percentages and columns.
+    """
+    path = Path(path)
+
+    if is_split(path):
+        features_path, positions, fingerprints = read_split(path)
+        if percentages is not None:
+            positions = {percentage: positions[percentage] for percentage in percentages}
+        # The fingerprint columns are needed to check the features, even if not requested
+        extra = [] if columns is None else [column for column in FINGERPRINT_COLUMNS if column not in columns]
+        features = load_features(features_path, list(positions), None if columns is None else list(columns) + extra,
+                                 use_ewma, use_gradient)
+        return {percentage: df.drop(columns=extra)
+                for percentage, df in SplitFeatures(features, positions, fingerprints).items()}
+
+    if is_pickle(path) or path.is_file():
+        with open(path, "rb") as f:
+            features_at_percent = pickle.load(f)
+        if percentages is not None:
+            features_at_percent = {percentage: features_at_percent[percentage] for percentage in percentages}
+        return {
+            percentage: df[select_columns([column for column in (columns or df.columns) if column in df],
+                                          use_ewma, use_gradient)]
+            for percentage, df in features_at_percent.items()
+        }
+
+    manifest = read_manifest(path)
+    if percentages is None:
+        percentages = [int(percentage) for percentage in manifest["percentages"]]
+    return {
+        percentage: read_percentage(path, percentage, columns, use_ewma, use_gradient, manifest=manifest)
+        for percentage in percentages
+    }
+
+
+@functools.lru_cache(maxsize=2)
+def _read_percentage_cached(path: str, percentage: int) -> pd.DataFrame:
+    return read_percentage(path, percentage, mapped=True)
+
+
+class MappedFeatures(Mapping):
+    """
+    Read-only dict[int, DataFrame] view of a store. Percentages are mapped on
+    first access (see read_percentage with mapped) and the most recent ones are
+    cached per process. It pickles as just the store path, so handing it to
+    worker processes costs nothing. The numeric and boolean columns of the cached
+    frames are backed by the page cache, which all workers share. Each worker
+    only holds private copies of the categorical columns, and of whatever it
+    derives from a frame: selecting rows or columns (e.g. SplitFeatures, or the
+    view a target is cross validated on) copies.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._percentages = store_percentages(path)
+
+    def __getitem__(self, percentage) -> pd.DataFrame:
+        if percentage not in self._percentages:
+            raise KeyError(percentage)
+        # Cached frames are shared between callers, they must not be modified in place
+        return _read_percentage_cached(self.path, percentage)
+
+    def __iter__(self):
+        return iter(self._percentages)
+
+    def __len__(self):
+        return len(self._percentages)
+
+    def __reduce__(self):
+        return MappedFeatures, (self.path,)
+
+
+def fingerprint(features: pd.DataFrame) -> str:
+    """
+    Identifies the rows of a percentage: their number and a hash of their problems
+    (mzn, dzn) in order, so a split manifest notices features whose rows were
+    reordered or replaced since.
+    """
+    problems = features["mzn"].astype(str) + "|" + features["dzn"].astype(str)
+    return f"{len(features)}:{hashlib.sha1(chr(10).join(problems).encode()).hexdigest()}"
+
+
+def save_split(path, features_path, positions: dict[int, np.ndarray], fingerprints: dict[int, str]):
+    """
+    Writes a split manifest: the row positions of the split per percentage, into
+    the features at features_path, with the fingerprint of those features per
+    percentage. The features path is stored relative to the manifest.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    features_path = os.path.relpath(Path(features_path).resolve(), path.parent.resolve())
+    arrays = {"features": np.array(features_path)}
+    for percentage, percentage_positions in positions.items():
+        arrays[f"positions_{percentage}"] = np.asarray(percentage_positions, dtype=np.int32)
+        arrays[f"fingerprint_{percentage}"] = np.array(fingerprints[percentage])
+    np.savez_compressed(path, **arrays)
+
+
+def read_split(path) -> tuple[Path, dict[int, np.ndarray], dict[int, str]]:
+    """
+    Reads a split manifest. Returns the path of the features it points into, and
+    the row positions and the fingerprint of the features per percentage.
+    """
+    path = Path(path)
+    with np.load(path) as split:
+        features_path = path.parent / str(split["features"])
+        percentages = sorted(int(key.removeprefix("positions_")) for key in split.files
+                             if key.startswith("positions_"))
+        positions = {percentage: split[f"positions_{percentage}"] for percentage in percentages}
+        fingerprints = {percentage: str(split[f"fingerprint_{percentage}"]) for percentage in percentages}
+    return features_path, positions, fingerprints
+
+
+class SplitFeatures(Mapping):
+    """
+    Read-only dict[int, DataFrame] view of the rows of a split in features (a
+    dict or MappedFeatures). Percentages are sliced on access, after checking
+    the features against the fingerprint of the split. Pickling it only pickles
+    the features (a path for MappedFeatures), the positions and the fingerprints.
+    """
+
+    def __init__(self, features: Mapping, positions: dict[int, np.ndarray], fingerprints: dict[int, str]):
+        self.features = features
+        self.positions = positions
+        self.fingerprints = fingerprints
+
+    def __getitem__(self, percentage) -> pd.DataFrame:
+        if percentage not in self.positions:
+            raise KeyError(percentage)
+        features = self.features[percentage]
+        if fingerprint(features) != self.fingerprints[percentage]:
+            raise ValueError(f"The split at {percentage}% was made from other features than it points into "
+                             f"(rows reordered or replaced since), it has to be made again")
+        return features.iloc[self.positions[percentage]]
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+
+def save_features(features_at_percent: dict[int, pd.DataFrame], path):
+    """
+    Saves features at percent as a pickle if path ends in .pkl/.pickle, as a store otherwise.
+    """
+    if is_pickle(path):
+        # Written next to it and then replaced, so a failed run keeps the previous pickle
+        partial = Path(f"{path}.part")
+        with open(partial, "wb") as f:
+            pickle.dump(features_at_percent, f)
+        os.replace(partial, path)
+    else:
+        write_feature_store(features_at_percent, path)
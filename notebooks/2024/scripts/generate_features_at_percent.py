@@ -1,17 +1,45 @@
+import functools
+import gzip
+import hashlib
 import json
+import multiprocessing
+import os
 import pickle
+import re
 import sys
 import math
 from argparse import ArgumentParser
 from glob import glob
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 from rich.progress import track
 from rich.logging import RichHandler
 from sklearn.model_selection import train_test_split
 import logging
 
+from feature_store import save_features
+from instrumentation import Instrumentation
+
+# Decoding the solver outputs is the hot loop, use a faster parser if one is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import simdjson
+        _simdjson_parser = simdjson.Parser()
+
+        def json_loads(data):
+            return _simdjson_parser.parse(data).as_dict()
+    except ImportError:
+        json_loads = json.loads
+
+# Binary solver traces are read with the reader next to save_solver_output.py
+sys.path.append(str(Path(__file__).resolve().parents[3] / "workflow" / "scripts"))
+from solver_trace import SolverTrace, is_trace
+
 logging.basicConfig(
     level="NOTSET", format="%(message)s", datefmt="[%X]", handlers=[RichHandler()]
 )
@@ -19,209 +47,448 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+TIME_LIMIT = 60 * 60 * 2  # seconds
+MAX_SNAPSHOT_DISTANCE = 72  # seconds, a snapshot further from a half percent mark is not used
+# Version of the sampled problems in the --cache_dir cache, bump it whenever load_problem()
+# or the sampling changes what it returns, so entries of older code are parsed again
+CACHE_VERSION = 2
+GZIP_MAGIC = b'\x1f\x8b'
+SEARCH_TIME_PATTERN = re.compile(rb'"search_time":\s*(-?[0-9][0-9.eE+-]*)')
+
+# Statistics (and features from "Equations to match report") that get a gradient
+GRADIENT_KEYS = ['conflicts', 'ewma_conflicts', 'decisions', 'search_iterations', 'opennodes', 'ewma_opennodes',
+                 'vars', 'back_jumps', 'ewma_back_jumps', 'solutions', 'total_time', 'intVars', 'search_time',
+                 'propagations', 'sat_propagations', 'ewma_propagations', 'propagators', 'boolVars', 'learnt',
+                 'bin', 'tern', 'long', 'peak_depth', 'decision_level_engine', 'ewma_decision_level_engine',
+                 'decision_level_treesize', 'clause_mem', 'prop_mem', 'frac_prop_vars', 'log_of_unassn_var',
+                 'freq_backjumps', 'frac_bool_vars', 'frac_long_clauses',
+                 'log_of_fraction_of_failures_versus_unassigned', 'log_of_frac_unassign_var']
+
+
+def find_indices_at_percent(search_time: np.ndarray, times: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Looks up the snapshot nearest to each of times in a sorted search_time column,
+    all in one searchsorted call, with the same rules as HalfPercentSampler: a
+    time is only resolved by a snapshot past it, and ties go to the later
+    snapshot. Returns the index of the snapshot per time (-1 if unresolved) and
+    its distance (inf if unresolved); the caller decides which distance is too far.
+    """
+    times = np.asarray(times, dtype=float)
+    if len(search_time) == 0:
+        return np.full(len(times), -1), np.full(len(times), np.inf)
 
-# find index of statistics array at certain percent of TL
-def find_index_at_percent(stats, wall_clock_time_to_find):
-    left = 0
-    right = len(stats) - 1
-    while left <= right:
-        mid = (left + right) // 2
-
-        if stats[mid] is not None:
-
-            if abs(left - right) <= 1:
-                left_time_at_convergence = stats[left]['search_time']
-                right_time_at_convergence = stats[right]['search_time']
-
-                left_difference = abs(wall_clock_time_to_find - left_time_at_convergence)
-                right_difference = abs(wall_clock_time_to_find - right_time_at_convergence)
+    after = np.searchsorted(search_time, times, side='right')
+    resolved = after < len(search_time)
+    after = np.minimum(after, len(search_time) - 1)
+    before = np.maximum(after - 1, 0)
+    nearest = np.where((after > 0) & (times - search_time[before] < search_time[after] - times), before, after)
 
-                if left_difference < right_difference:
-                    value = left_time_at_convergence
-                    difference = left_difference
-                    index_to_return = left
-                else:
-                    value = right_time_at_convergence
-                    difference = right_difference
-                    index_to_return = right
+    indices = np.where(resolved, nearest, -1)
+    distances = np.where(resolved, np.abs(search_time[nearest] - times), np.inf)
+    return indices, distances
 
-                if difference > 72:
-                    return -1
-                return index_to_return
 
-            elif stats[mid]['search_time'] < wall_clock_time_to_find:
-                left = mid
-            else:
-                right = mid
-        else:
-            logger.warning("none? %d", mid)
-            return -1
+class HalfPercentSampler:
+    """
+    Picks the statistics snapshot nearest to every half percent of the time limit
+    from a stream of snapshots ordered by search_time. Only the previous snapshot
+    and the picked ones are kept in memory, so a trace is sampled in one pass
+    without loading it whole.
+    """
 
-    logger.warning("%d never converges?", mid)
-    return -1
+    def __init__(self, time_limit=TIME_LIMIT, max_distance=MAX_SNAPSHOT_DISTANCE):
+        self.time_limit = time_limit
+        self.max_distance = max_distance
+        self.statistics_per_half_percent = {}
+        self.final_statistic = None
+        self._previous = None
+        self._percent = 1
+
+    def time_at_percent(self, percent):
+        # percent counts half percents, so 200 is the full time limit
+        return self.time_limit * percent / 100 / 2
+
+    def push(self, statistic):
+        """
+        Feed the next snapshot of the trace (None for a line without statistics).
+        Returns the half percents that were resolved by it (a half percent is
+        resolved once a snapshot past it is seen).
+        """
+        # The statistics of the last line, so a problem whose output ends without
+        # statistics has none and is dropped
+        self.final_statistic = statistic
+        if statistic is None:
+            return []
+
+        if "search_time" not in statistic:
+            return []
+
+        resolved = []
+        search_time = statistic['search_time']
+        while self._percent < 200 and self.time_at_percent(self._percent) < search_time:
+            time_at_percent = self.time_at_percent(self._percent)
+            nearest = statistic
+            if self._previous is not None and \
+                    time_at_percent - self._previous['search_time'] < search_time - time_at_percent:
+                nearest = self._previous
+
+            if abs(nearest['search_time'] - time_at_percent) <= self.max_distance:
+                self.statistics_per_half_percent[self._percent] = nearest
+                resolved.append(self._percent)
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug("no snapshot within %ds of %.1fs", self.max_distance, time_at_percent)
+
+            self._percent += 1
+
+        self._previous = statistic
+        return resolved
+
+
+def open_output(path):
+    """
+    Opens a solver output for reading in binary mode, gzipped (save_solver_output.py
+    --compress) or not.
+    """
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
 
 
-def load_to_dataframe(input_dir: Path) -> pd.DataFrame:
-    all_normal_files = glob(str(input_dir / "*NORMAL.json"))
-    all_normal_files = list(all_normal_files)
-    df = pd.DataFrame()
-    data = []
+def raw_search_time(line: bytes):
+    """
+    The search_time of a raw statistics line, without decoding the line.
+    """
+    match = SEARCH_TIME_PATTERN.search(line)
+    return float(match.group(1)) if match else None
 
-    num_without_search_time = 0
-    for i, normal in track(enumerate(all_normal_files), description="Loading data", total=len(all_normal_files),
-                           transient=True):
-        mzn = normal[normal.find("MZN-") + 4:normal.find("-DZN")] + ".mzn"
-        dzn = normal[normal.find("DZN-") + 4:normal.find("-OUTPUT")] + ".dzn"
 
-        stats = Path(f"{normal[:-12]}-STATS.json")
-        if stats.exists():
-            with open(normal, 'r') as normal_output, open(f"{normal[:-12]}-STATS.json", 'r') as stats_output:
-                line = normal_output.readline()
-                if line:  # don't read json from empty output
+class RawSnapshot:
+    """
+    A statistics line that is only decoded if it is picked by the sampler.
+    """
+    __slots__ = ('search_time', 'line')
 
-                    normal_time = json.loads(line).get('time')  # wall time
-                    stats_all_lines = [json.loads(line).get('statistics') for line in stats_output.readlines()]
-                    final_statistic = stats_all_lines[-1]
+    def __init__(self, search_time, line):
+        self.search_time = search_time
+        self.line = line
 
-                    # plot_dataframe_column(pd.DataFrame(stats_all_lines), 'search_time')
+    def __contains__(self, key):
+        return key == 'search_time'
 
-                    if normal_time and final_statistic:
-                        if "search_time" not in final_statistic.keys():
-                            num_without_search_time += 1
-                        else:
-                            normal_time *= 0.001  # Convert from milliseconds to seconds
+    def __getitem__(self, key):
+        return self.search_time
 
-                            if normal_time <= 10:
-                                continue
+    def decode(self):
+        return json_loads(self.line).get('statistics')
 
-                            # To avoid loading in too much data into memory, only load the ones at certain percentages
-                            # specifically, every half percent intervals
-                            statistics_per_half_percent = {}
-                            for percent in range(1, 200):
 
-                                # normal_time is in seconds, so this is percentage of two hours
-                                wall_clock_time_at_percent = (60 * 60 * 2) * percent / 100 / 2
+def sample_statistics(stats_output) -> HalfPercentSampler:
+    """
+    Streams a STATS json-stream file (opened in binary mode) line by line through
+    a HalfPercentSampler. Only the search_time of every line is read; just the
+    picked snapshots and the last line are decoded.
+    """
+    sampler = HalfPercentSampler()
+    last = None
+    for line in stats_output:
+        if line.strip():
+            last = line
+        if b'"statistics"' not in line:
+            continue
+        search_time = raw_search_time(line)
+        if search_time is not None:
+            sampler.push(RawSnapshot(search_time, line))
+
+    if last is not None:
+        sampler.final_statistic = json_loads(last).get('statistics')
+
+    decoded = {}
+    for percent, snapshot in sampler.statistics_per_half_percent.items():
+        if id(snapshot) not in decoded:
+            decoded[id(snapshot)] = snapshot.decode()
+        sampler.statistics_per_half_percent[percent] = decoded[id(snapshot)]
+    return sampler
+
+
+def sample_trace(trace: SolverTrace) -> HalfPercentSampler:
+    """
+    Same sampling as sample_statistics() for a binary trace, by a binary search on
+    its search_time column instead of streaming every snapshot.
+    """
+    sampler = HalfPercentSampler()
+    sampler.final_statistic = trace.last_statistics()
+    percents = np.arange(1, 200)
+    search_time = np.asarray(trace.search_time, dtype=float)
+
+    # Snapshots that did not fit the schema are in the footer, merged back in output
+    # order: a footer line comes before the row it precedes
+    footer = trace.footer_statistics()
+    if footer:
+        order = np.argsort(np.concatenate([np.arange(trace.rows) * 2 + 1,
+                                           np.array([position * 2 for position, _ in footer], dtype=int)]),
+                           kind='stable')
+        search_time = np.concatenate([search_time, [statistics['search_time'] for _, statistics in footer]])[order]
+
+    indices, distances = find_indices_at_percent(search_time, sampler.time_at_percent(percents))
+    resolved = distances <= sampler.max_distance
+    indices = indices[resolved]
+    if not footer:
+        statistics = trace.rows_at(indices)
+    else:
+        indices = order[indices]
+        statistics = [footer[index - trace.rows][1] if index >= trace.rows else trace.row(index) for index in indices]
+
+    sampler.statistics_per_half_percent = dict(zip(percents[resolved].tolist(), statistics))
+    return sampler
+
+
+def load_problem(normal: str):
+    """
+    Reads the NORMAL/STATS output pair of a single problem and samples its
+    statistics at every half percent. Returns None if the problem is unusable.
+    """
+    mzn = normal[normal.find("MZN-") + 4:normal.find("-DZN")] + ".mzn"
+    dzn = normal[normal.find("DZN-") + 4:normal.find("-OUTPUT")] + ".dzn"
+
+    stats = Path(f"{normal[:-12]}-STATS.json")
+    if not stats.exists():
+        return None
+
+    if is_trace(normal):
+        line = SolverTrace(normal).first_line()
+    else:
+        with open_output(normal) as normal_output:
+            line = normal_output.readline()
+    if not line:  # don't read json from empty output
+        return None
+
+    normal_time = json_loads(line).get('time')  # wall time
+    if not normal_time:
+        return None
+
+    normal_time *= 0.001  # Convert from milliseconds to seconds
+    if normal_time <= 10:
+        return None
+
+    # To avoid loading in too much data into memory, the trace is streamed and only
+    # the snapshots at every half percent of the time limit are kept
+    if is_trace(stats):
+        sampler = sample_trace(SolverTrace(stats))
+    else:
+        with open_output(stats) as stats_output:
+            sampler = sample_statistics(stats_output)
+    final_statistic = sampler.final_statistic
+
+    if not final_statistic or "search_time" not in final_statistic.keys():
+        return None
+
+    return {
+        'normal_time': normal_time,
+        'stat_time': final_statistic['search_time'],
+        'problem': normal,
+        'statistics': sampler.statistics_per_half_percent,
+        'mzn': mzn,
+        'dzn': dzn
+    }
+
+
+def map_problems(function, items, num_processes: int, description: str):
+    """
+    Applies function to every item, in order, across num_processes worker
+    processes (or in this process if num_processes is 1).
+    """
+    if num_processes <= 1:
+        yield from track(map(function, items), description=description, total=len(items), transient=True)
+        return
 
-                                if wall_clock_time_at_percent >= final_statistic['search_time']:  # no more data :(
-                                    break
+    chunksize = max(1, len(items) // (num_processes * 16))
+    with multiprocessing.Pool(num_processes) as pool:
+        yield from track(pool.imap(function, items, chunksize=chunksize), description=description,
+                         total=len(items), transient=True)
 
-                                logger.debug("searching for", wall_clock_time_at_percent)
 
-                                index_for_percent = find_index_at_percent(stats_all_lines, wall_clock_time_at_percent)
-                                logger.debug(index_for_percent)
+def output_fingerprint(normal: str):
+    """
+    Modification time and size of the NORMAL and STATS output of a problem (None if missing).
+    """
+    fingerprint = []
+    for output in (Path(normal), Path(f"{normal[:-12]}-STATS.json")):
+        try:
+            stat = output.stat()
+            fingerprint.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            fingerprint.append(None)
+    return fingerprint
 
-                                if index_for_percent == -1:
-                                    statistics_per_half_percent[percent] = None
 
-                                logger.debug(stats_all_lines[index_for_percent]['search_time'])
+def cache_version():
+    """
+    What a cached problem depends on besides its outputs: the cache version and the
+    sampling parameters.
+    """
+    return CACHE_VERSION, TIME_LIMIT, MAX_SNAPSHOT_DISTANCE
 
-                                statistics_per_half_percent[percent] = stats_all_lines[index_for_percent]
 
-                            data.append({
-                                'normal_time': normal_time,
-                                'stat_time': final_statistic['search_time'],
-                                'problem': normal,
-                                'statistics': statistics_per_half_percent,
-                                'mzn': mzn,
-                                'dzn': dzn
-                            })
+def load_problem_cached(normal: str, cache_dir: Path):
+    """
+    load_problem() with a per-problem cache, keyed by the path of the NORMAL output
+    and the fingerprint of both outputs, so only new or changed outputs are parsed.
+    Entries of another cache_version() are parsed again. Returns the problem (or
+    None) and whether it came from the cache.
+    """
+    fingerprint = output_fingerprint(normal)
+    version = cache_version()
+    cache_path = cache_dir / f"{hashlib.sha1(normal.encode()).hexdigest()}.pkl"
+
+    if cache_path.exists():
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('version') == version and cached['normal'] == normal and cached['fingerprint'] == fingerprint:
+            return cached['problem'], True
+
+    problem = load_problem(normal)
+
+    # Written under a temporary name, so an interrupted run does not leave a broken entry
+    partial_path = cache_path.with_suffix(f".{os.getpid()}.part")
+    with open(partial_path, 'wb') as f:
+        pickle.dump({'version': version, 'normal': normal, 'fingerprint': fingerprint, 'problem': problem}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(partial_path, cache_path)
+    return problem, False
+
+
+def load_to_dataframe(input_dir: Path, num_processes: int = 1, cache_dir: Path = None) -> pd.DataFrame:
+    # Sorted, so the rows of a regenerated store are in the same order (split manifests index them)
+    all_normal_files = sorted(glob(str(input_dir / "*NORMAL.json")))
+
+    if cache_dir is None:
+        data = [problem for problem in map_problems(load_problem, all_normal_files, num_processes, "Loading data")
+                if problem is not None]
+    else:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        data, reused = [], 0
+        for problem, cached in map_problems(functools.partial(load_problem_cached, cache_dir=cache_dir),
+                                            all_normal_files, num_processes, "Loading data"):
+            reused += cached
+            if problem is not None:
+                data.append(problem)
+        logger.info("Reused %d cached problems, parsed %d new or changed ones", reused, len(all_normal_files) - reused)
+
+    if len(data) != len(all_normal_files):
+        logger.info("Skipped %d problems without usable output", len(all_normal_files) - len(data))
 
     df = pd.DataFrame(data)
 
     return df
 
 
-def cleanup(df):
-    if "decision_level_sat" in df:
-        del df["decision_level_sat"]
-    if "ewma_decision_level_mip" in df:
-        del df["ewma_decision_level_mip"]
-    if "decision_level_mip" in df:
-        del df["decision_level_mip"]
-
-    # Added
-    del df["best_objective"]
-    del df["ewma_best_objective"]
-
-    #Previous equations:
-    # df["unassnVar"]   = (2**df['vars']) - df['decisions']
-    # df["fracFailUnassn"]     = df['conflicts'] / df['unassnVar']         # num failures/ num open nodes
-    # df["fracOpenVisit"] = (df['vars'] - df['opennodes']) / (df['opennodes'] + sys.float_info.epsilon)  # ratio of open nodes to visited nodes (how much of soln space explored)
-    # df["fracBoolVars"] = df['boolVars'] / (df['vars'] + sys.float_info.epsilon)  # num bools / total num of vars
-    # df["fracPropVars"] = df['propagations'] / (
-    #         df['vars'] + sys.float_info.epsilon)  # num propagations/ total num of vars
-    # df["frac_unassigned"] = df['unassnVar'] / (2**df['vars'])  # current assignments/ total vars
-    # df["fracLongClauses"] = df['long'] + df['bin'] + df[
-    #     'tern']  # fraction of learnt clauses that have more than 3 literals
-    # df["freqBackjumps"] = df['back_jumps'] / (df['search_time'] + sys.float_info.epsilon)
-    # del df["unassnVar"]
-    
-    # Equations to match report:
-    df["log_of_unassn_var"] = df['vars'] * math.log(2) - math.log(df['decisions'] if df['propagations'] != 0 else 1) - math.log(df['propagations'] if df['propagations'] != 0 else 1)
-#     df["unassnVar"]   = (df['vars'] * log(2) - log(df['decisions'])
-    df["frac_prop_vars"] = df['propagations'] / (df['vars']) if df['vars'] != 0 else 0  # num propagations/ total num of vars
-    df["freq_backjumps"] = df['back_jumps'] / (df['search_time'] + sys.float_info.epsilon)
-    df["frac_bool_vars"] = df['boolVars'] / (df['vars']) if df['vars'] != 0 else 0  # num bools / total num of vars
-    all_clauses = (df['long'] + df['bin'] + df['tern'])
-    df["frac_long_clauses"] = df['long']/all_clauses if all_clauses != 0 else 0
-
-    df['log_of_frac_unassign_var'] = df['log_of_unassn_var'] - (df['vars'] * math.log(2))
-    df["log_of_fraction_of_failures_versus_unassigned"] = math.log(df['conflicts'] if df['conflicts']  != 0 else 1)  - df['log_of_unassn_var']
-    return df
-
-
-def gradients(df_prev, df_curr):
-    #For previous equations:
-    # keys = ['conflicts', 'ewma_conflicts', 'decisions', 'search_iterations', 'opennodes', 'ewma_opennodes',
-    #         'vars', 'back_jumps', 'ewma_back_jumps', 'solutions', 'total_time', 'intVars', 'search_time',
-    #         'propagations', 'sat_propagations', 'ewma_propagations', 'propagators', 'boolVars', 'learnt',
-    #         'bin', 'tern', 'long', 'peak_depth', 'decision_level_engine', 'ewma_decision_level_engine',
-    #         'decision_level_treesize', 'clause_mem', 'prop_mem',
-    #         'fracOpenVisit', 'fracBoolVars', 'fracPropVars', 'freqBackjumps']
-    
-    # Adding vars from "Equations to match report"
-    keys = ['conflicts', 'ewma_conflicts', 'decisions', 'search_iterations', 'opennodes', 'ewma_opennodes',
-            'vars', 'back_jumps', 'ewma_back_jumps', 'solutions', 'total_time', 'intVars', 'search_time',
-            'propagations', 'sat_propagations', 'ewma_propagations', 'propagators', 'boolVars', 'learnt',
-            'bin', 'tern', 'long', 'peak_depth', 'decision_level_engine', 'ewma_decision_level_engine',
-            'decision_level_treesize', 'clause_mem', 'prop_mem', 'frac_prop_vars', 'log_of_unassn_var',
-           'freq_backjumps', 'frac_bool_vars', 'frac_long_clauses', 'log_of_fraction_of_failures_versus_unassigned',
-           'log_of_frac_unassign_var']
-    for i in keys:
-        df_curr[i + '_gradient'] = (df_curr[i] - df_prev[i]) / 0.005 * 7200 #every half of percent of 2hr TL
-    return df_curr
-
-def create_features_at_percent(df, lag: int) -> dict[int, list]:
-    features_at_percent = {}
-
-    for i in track(range(1, 200), description="Creating features at percent (every half percent)", transient=True):
-        df_percent = []
-        for id, problem in df.iterrows():
+def cleanup_columns(columns: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """
+    Drops the optional statistics and adds the features of the report ("Equations
+    to match report"), over the statistics of all problems at one percentage,
+    given as one array per statistic.
+    """
+    columns = {key: value for key, value in columns.items()
+               if key not in ("decision_level_sat", "ewma_decision_level_mip", "decision_level_mip",
+                              "best_objective", "ewma_best_objective")}
+
+    n_vars = columns['vars'].astype(float)
+    decisions = columns['decisions'].astype(float)
+    propagations = columns['propagations'].astype(float)
+    conflicts = columns['conflicts'].astype(float)
+    long = columns['long'].astype(float)
+    all_clauses = long + columns['bin'] + columns['tern']
+
+    # The discarded branches of np.where may divide by zero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_of_unassn_var = n_vars * math.log(2) \
+            - np.log(np.where(propagations != 0, decisions, 1)) \
+            - np.log(np.where(propagations != 0, propagations, 1))
+        # log(0) for a problem with propagations but no decisions (a math domain error in the
+        # original code), NaN so the row is dropped, see create_features_at_percent
+        log_of_unassn_var[~np.isfinite(log_of_unassn_var)] = np.nan
+
+        columns["log_of_unassn_var"] = log_of_unassn_var
+        columns["frac_prop_vars"] = np.where(n_vars != 0, propagations / n_vars, 0)
+        columns["freq_backjumps"] = columns['back_jumps'] / (columns['search_time'] + sys.float_info.epsilon)
+        columns["frac_bool_vars"] = np.where(n_vars != 0, columns['boolVars'] / n_vars, 0)
+        columns["frac_long_clauses"] = np.where(all_clauses != 0, long / all_clauses, 0)
+        columns["log_of_frac_unassign_var"] = log_of_unassn_var - n_vars * math.log(2)
+        columns["log_of_fraction_of_failures_versus_unassigned"] = \
+            np.log(np.where(conflicts != 0, conflicts, 1)) - log_of_unassn_var
+
+    return columns
+
+
+def gradients_columns(columns_prev: dict[str, np.ndarray], columns_curr: dict[str, np.ndarray],
+                      previous_positions: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    Adds the _gradient of every GRADIENT_KEYS statistic between two percentages,
+    per half percent of the 2h time limit. previous_positions holds, for
+    every current row, its row in columns_prev or -1 if it has none; those rows
+    get NaN gradients and has_gradients False.
+    """
+    has_gradients = previous_positions != -1
 
-            if i in problem.statistics:
-                p = problem.statistics[i]
+    if has_gradients.any():
+        for key in GRADIENT_KEYS:
+            previous = np.full(len(previous_positions), np.nan)
+            previous[has_gradients] = columns_prev[key][previous_positions[has_gradients]]
+            columns_curr[key + '_gradient'] = (columns_curr[key] - previous) / 0.005 * 7200  # every half of percent of 2hr TL
 
-                # Apparently there are four instances that do not have all keys. No clue what happened there.
-                if len(p.keys()) != 33:
-                    continue
+    columns_curr['has_gradients'] = has_gradients
+    return columns_curr
 
-                new_p = dict(p)
-                new_p = cleanup(new_p)
 
-                new_p['mzn'] = problem['mzn']
-                new_p['dzn'] = problem['dzn']
-                new_p['solved_within_time_limit'] = problem['normal_time'] < 7199
+def create_features_at_percent(df, lag: int) -> dict[int, pd.DataFrame]:
+    """
+    Builds the sampled statistics of every problem at a percentage into one array
+    per statistic and derives the cleaned features and gradients on those arrays.
+    """
+    features_at_percent = {}
+    columns_at_percent = {}
+    mzn, dzn = df['mzn'].to_numpy(), df['dzn'].to_numpy()
+    solved_within_time_limit = df['normal_time'].to_numpy() < 7199
 
-                if i >= lag:
-                    if (i - lag) in features_at_percent and id in features_at_percent[i - lag].index:
-                        new_p = gradients(features_at_percent[i - lag].loc[id], new_p)
-                        new_p['has_gradients'] = True
-                    else:
-                        new_p['has_gradients'] = False
-                df_percent.append((id, new_p))
+    for i in track(range(1, 200), description="Creating features at percent (every half percent)", transient=True):
+        positions, rows = [], []
+        for position, statistics in enumerate(df['statistics']):
+            # Apparently there are four instances that do not have all keys. No clue what happened there.
+            if i in statistics and len(statistics[i].keys()) == 33:
+                positions.append(position)
+                rows.append(statistics[i])
+
+        if not rows:
+            features_at_percent[i] = pd.DataFrame()
+            continue
+
+        positions = np.array(positions)
+        # Not every problem reports the same (optional) statistics, rows get NaN for the ones they lack
+        keys = dict.fromkeys(key for row in rows for key in row)
+        columns = cleanup_columns({key: np.array([row.get(key, np.nan) for row in rows]) for key in keys})
+        undefined = np.isnan(columns['log_of_unassn_var'])
+        if undefined.any():
+            logger.info("Dropped %d problems at %.1f%% whose features are undefined (no decisions)",
+                        undefined.sum(), i / 2)
+            positions = positions[~undefined]
+            columns = {key: value[~undefined] for key, value in columns.items()}
+            if not len(positions):
+                features_at_percent[i] = pd.DataFrame()
+                continue
+        columns['mzn'] = mzn[positions]
+        columns['dzn'] = dzn[positions]
+        columns['solved_within_time_limit'] = solved_within_time_limit[positions]
+
+        if i >= lag:
+            if (i - lag) in columns_at_percent:
+                previous_positions, columns_prev = columns_at_percent[i - lag]
+                previous_positions = pd.Index(previous_positions).get_indexer(positions)
+            else:
+                previous_positions, columns_prev = np.full(len(positions), -1), {}
+            columns = gradients_columns(columns_prev, columns, previous_positions)
 
-        df_i = pd.DataFrame([a[1] for a in df_percent], index=[a[0] for a in df_percent])
-        features_at_percent[i] = df_i
+        columns_at_percent[i] = (positions, columns)
+        features_at_percent[i] = pd.DataFrame(columns, index=df.index[positions])
 
     return features_at_percent
 
@@ -241,21 +508,22 @@ def split_into_train_and_test(features_at_percent, random_state):
 
 def main():
     """
-    Script to convert the problem output json files to a pickle of a
-    dictionary of features at each percentage of the time limit.
+    Script to convert the problem output json files to a feature store (or pickle)
+    of the features at each percentage of the time limit.
     """
     parser = ArgumentParser(description="Convert output json files to features at percent")
     parser.add_argument(
         "--input_dir",
         type=str,
-        required=True,run_ablation.fish run_base_experiment.fish
+        required=True,
         help="Directory containing the output json files",
     )
     parser.add_argument(
         "--output_filename",
         type=str,
         required=True,
-        help="File to save the features at percent pickle file to",
+        help="Feature store directory to save the features at percent to "
+             "(a path ending in .pkl writes a single pickle instead)",
     )
     parser.add_argument(
         "--num_processes",
@@ -263,6 +531,17 @@ def main():
         default=1,
         help="Number of processes to use for multiprocessing",
     )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Directory to cache the sampled statistics of every problem in. Later runs only "
+             "parse the outputs that are new or changed since they were cached",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="JSON file to write the time, CPU time, peak memory and throughput of every stage to",
+    )
     parser.add_argument(
         "--lag",
         type=int,
@@ -275,20 +554,28 @@ def main():
     output_filename = args.output_filename
     output_dir = Path(args.output_filename).parent
     output_dir.mkdir(parents=True, exist_ok=True)
-    logger.debug(f"Created output directory {output_dir}")
+    logger.debug("Created output directory %s", output_dir)
+    instrumentation = Instrumentation("generate_features_at_percent")
 
     # Load the problem output json files into a dataframe
-    df = load_to_dataframe(input_dir)
-    logger.info(f"Loaded {len(df)} problem output json files into a dataframe")
+    with instrumentation.stage("load_to_dataframe") as stage:
+        df = load_to_dataframe(input_dir, args.num_processes, Path(args.cache_dir) if args.cache_dir else None)
+        stage.count(files=len(glob(str(input_dir / "*NORMAL.json"))), rows=len(df))
+    logger.info("Loaded %d problem output json files into a dataframe", len(df))
 
     # Create features at each percentage of the time limit
-    features_at_percent = create_features_at_percent(df, args.lag)
+    with instrumentation.stage("create_features_at_percent") as stage:
+        features_at_percent = create_features_at_percent(df, args.lag)
+        stage.count(rows=sum(len(features) for features in features_at_percent.values()))
     logger.info("Created features at each percentage of the time limit")
 
-    with open(f"{output_filename}", "wb") as f:
-        pickle.dump(features_at_percent, f)
+    with instrumentation.stage("save_features", rows=stage.counts["rows"]):
+        save_features(features_at_percent, output_filename)
+
+    logger.info("Saved features at percent to %s", output_filename)
 
-    logger.info(f"Saved features at percent dict to {output_filename}")
+    if args.report:
+        instrumentation.write_report(args.report)
 
 
 if __name__ == "__main__":
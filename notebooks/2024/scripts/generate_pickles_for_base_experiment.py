@@ -1,22 +1,27 @@
-
-import pickle
 from argparse import ArgumentParser
 from pathlib import Path
 
+import numpy as np
 from sklearn.model_selection import train_test_split
 import logging
 
+from feature_store import FINGERPRINT_COLUMNS, fingerprint, load_features, save_split
+from instrumentation import Instrumentation
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def split_into_train_and_test(features_at_percent, random_state):
+def split_into_train_and_test(features_at_percent, random_state, test_size=0.1):
+    """
+    Returns the row positions of the train and the test set per percentage.
+    """
     train_at_percentage = {}
     test_at_percentage = {}
 
     for percentage in range(1, 41):
         labels = features_at_percent[percentage]['solved_within_time_limit']
-        train, test = train_test_split(features_at_percent[percentage], test_size=0.1, random_state=random_state, stratify=labels)
+        train, test = train_test_split(np.arange(len(labels)), test_size=test_size, random_state=random_state, stratify=labels)
         train_at_percentage[percentage] = train
         test_at_percentage[percentage] = test
 
@@ -32,41 +37,57 @@ def main():
         "--input",
         type=str,
         required=True,
-        help="Pickle containing the features at percent",
+        help="Feature store (or pickle) containing the features at percent",
     )
     parser.add_argument(
         "--output",
         type=str,
         required=True,
-        help="Base filename of train set splits",
+        help="Base filename of the split manifests (<output>_train.npz and <output>_test.npz), "
+             "with {seed} in it if there are multiple seeds",
     )
     parser.add_argument(
         "--random",
         type=int,
-        default=5,
-        help="The seed for the random number generator",
+        nargs="+",
+        default=[5],
+        help="The seeds for the random number generator, one split per seed",
+    )
+
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="JSON file to write the time, CPU time, peak memory and throughput of every stage to",
     )
 
     args = parser.parse_args()
+    if len(args.random) > 1 and "{seed}" not in args.output:
+        parser.error("--output needs {seed} in it to split with multiple seeds")
 
     input_features_path = Path(args.input)
-    output_filename = args.output
-    output_dir = Path(args.output).parent
-    output_dir.mkdir(parents=True, exist_ok=True)
-    logger.debug(f"Created output directory {output_dir}")
 
-    with open(input_features_path, "rb") as f:
-        features_at_percent = pickle.load(f)
+    instrumentation = Instrumentation(Path(__file__).stem)
+
+    with instrumentation.stage("load_features") as stage:
+        features_at_percent = load_features(input_features_path, percentages=range(1, 41),
+                                            columns=['solved_within_time_limit', *FINGERPRINT_COLUMNS])
+        stage.count(rows=sum(len(features) for features in features_at_percent.values()))
+
+    fingerprints = {percentage: fingerprint(features) for percentage, features in features_at_percent.items()}
+    for seed in args.random:
+        output_filename = args.output.format(seed=seed)
 
-    train, test = split_into_train_and_test(features_at_percent, random_state=args.random)
+        with instrumentation.stage(f"split_{seed}", rows=stage.counts["rows"]):
+            train, test = split_into_train_and_test(features_at_percent, random_state=seed)
 
-    with open(f"{output_filename}_train.pkl", "wb") as f:
-        pickle.dump(train, f)
+        with instrumentation.stage(f"save_split_{seed}", rows=stage.counts["rows"]):
+            save_split(f"{output_filename}_train.npz", input_features_path, train, fingerprints)
+            save_split(f"{output_filename}_test.npz", input_features_path, test, fingerprints)
 
-    with open(f"{output_filename}_test.pkl", "wb") as f:
-        pickle.dump(test, f)
+        logger.info("Saved the split of seed %d to %s", seed, output_filename)
 
-    logger.info(f"Saved features at percent dict to {output_filename}")
+    if args.report:
+        instrumentation.write_report(args.report)
 
 
 if __name__ == "__main__":
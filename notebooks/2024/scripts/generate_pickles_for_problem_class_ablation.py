@@ -1,52 +1,54 @@
-import pickle
 from argparse import ArgumentParser
-
 from pathlib import Path
-from typing import List
-import random
+import logging
+
+import numpy as np
+import pandas as pd
 
+from feature_store import FINGERPRINT_COLUMNS, fingerprint, load_features, save_split
+from instrumentation import Instrumentation
 
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
-def size_for_set_of_labels(problem_with_counts: dict[str, int], problems: list[str]):
-    return sum(problem_with_counts[i] for i in problems)
 
-def knapsack(problem_with_counts: dict[str, int], percentage_split=0.2, random_state=42) -> List[str]:
+def problem_counts(features_at_percent) -> pd.Series:
     """
-    Takes a set of unique problems (by mzn) and returns a subset of unique problems
-    that approximate a % split. Allows to set a random state in order to randomize datasets.
+    Rows per unique problem (by mzn), over all percentages.
     """
-    random.seed(random_state)
-    stack = []
-    total_length = sum(problem_with_counts.values())
-    size_for_set_of_labels = 0
+    return pd.concat([features['mzn'] for features in features_at_percent.values()]).value_counts()
 
-    # Loop until target size is reached or all problems are considered
-    while size_for_set_of_labels < percentage_split * total_length and problem_with_counts:
-        # Randomly choose the next problem (weighted by count)
-        next_choice = random.choices(list(problem_with_counts.keys()), k=1)
 
-        # Add chosen problem to stack (ensuring uniqueness)
-        if next_choice[0] not in stack:
-            stack.append(next_choice[0])
-            size_for_set_of_labels += problem_with_counts[next_choice[0]]
-            del problem_with_counts[next_choice[0]]  # Remove processed problem
+def split_problems(problem_counts: pd.Series, percentage_split=0.2, random_state=42) -> list[str]:
+    """
+    Takes the row counts of the unique problems (by mzn) and returns a subset of
+    the problems that approximates a % split of the rows: the shortest prefix of
+    a random permutation of the problems that reaches the split. Allows to set a
+    random state in order to randomize datasets.
+    """
+    if problem_counts.empty:
+        return []
+    # Sorted first, so the permutation of a seed does not depend on the order of the counts
+    problem_counts = problem_counts.sort_index()
+    order = np.random.default_rng(random_state).permutation(len(problem_counts))
+    cumulative = np.cumsum(problem_counts.to_numpy()[order])
+    size = np.searchsorted(cumulative, percentage_split * cumulative[-1]) + 1
+    return problem_counts.index[order[:size]].tolist()
 
-    return stack
 
-def split_into_train_and_test(features_at_percent, random_state):
+def split_into_train_and_test(features_at_percent, test_problems):
+    """
+    Splits every percentage on the same problems, so a problem is in the test set
+    either at all percentages or at none. Returns the row positions of the train
+    and the test set per percentage.
+    """
     train_at_percentage = {}
     test_at_percentage = {}
 
-    for percentage in range(1, 41):
-        model_counts: dict[str, int] = features_at_percent[percentage]['mzn'].value_counts().to_dict()
-        print(model_counts)
-        
-        percentage_subset_of_problems = knapsack(model_counts, percentage_split=0.2, random_state=random_state)
-
-        train_at_percentage[percentage] = features_at_percent[percentage][~features_at_percent[percentage]['mzn'].isin(percentage_subset_of_problems)]
-        test_at_percentage[percentage] = features_at_percent[percentage][features_at_percent[percentage]['mzn'].isin(percentage_subset_of_problems)]
-
-        print(train_at_percentage[percentage].columns[train_at_percentage[percentage].isna().any()].tolist())
+    for percentage, features in features_at_percent.items():
+        is_test = features['mzn'].isin(test_problems).to_numpy()
+        train_at_percentage[percentage] = np.flatnonzero(~is_test)
+        test_at_percentage[percentage] = np.flatnonzero(is_test)
 
     return train_at_percentage, test_at_percentage
 
@@ -60,38 +62,61 @@ def main():
         "--input",
         type=str,
         required=True,
-        help="Pickle containing the features at percent",
+        help="Feature store (or pickle) containing the features at percent",
     )
     parser.add_argument(
         "--output",
         type=str,
         required=True,
-        help="Base filename of train set splits",
+        help="Base filename of the split manifests (<output>_train.npz and <output>_test.npz), "
+             "with {seed} in it if there are multiple seeds",
     )
     parser.add_argument(
         "--random",
         type=int,
-        default=5,
-        help="The seed for the random number generator",
+        nargs="+",
+        default=[5],
+        help="The seeds for the random number generator, one split per seed",
+    )
+
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="JSON file to write the time, CPU time, peak memory and throughput of every stage to",
     )
 
     args = parser.parse_args()
+    if len(args.random) > 1 and "{seed}" not in args.output:
+        parser.error("--output needs {seed} in it to split with multiple seeds")
 
     input_features_path = Path(args.input)
-    output_filename = args.output
-    output_dir = Path(args.output).parent
-    output_dir.mkdir(parents=True, exist_ok=True)
 
-    with open(input_features_path, "rb") as f:
-        features_at_percent = pickle.load(f)
+    instrumentation = Instrumentation(Path(__file__).stem)
+
+    with instrumentation.stage("load_features") as stage:
+        features_at_percent = load_features(input_features_path, percentages=range(1, 41), columns=FINGERPRINT_COLUMNS)
+        stage.count(rows=sum(len(features) for features in features_at_percent.values()))
+
+    with instrumentation.stage("count_problems") as counting:
+        counts = problem_counts(features_at_percent)
+        counting.count(problems=len(counts))
+
+    fingerprints = {percentage: fingerprint(features) for percentage, features in features_at_percent.items()}
+    for seed in args.random:
+        output_filename = args.output.format(seed=seed)
+
+        with instrumentation.stage(f"split_{seed}", rows=stage.counts["rows"]):
+            test_problems = split_problems(counts, percentage_split=0.2, random_state=seed)
+            train, test = split_into_train_and_test(features_at_percent, test_problems)
 
-    train, test = split_into_train_and_test(features_at_percent, random_state=args.random)
+        with instrumentation.stage(f"save_split_{seed}", rows=stage.counts["rows"]):
+            save_split(f"{output_filename}_train.npz", input_features_path, train, fingerprints)
+            save_split(f"{output_filename}_test.npz", input_features_path, test, fingerprints)
 
-    with open(f"{output_filename}_train.pkl", "wb") as f:
-        pickle.dump(train, f)
+        logger.info("Saved the split of seed %d (%d test problems) to %s", seed, len(test_problems), output_filename)
 
-    with open(f"{output_filename}_test.pkl", "wb") as f:
-        pickle.dump(test, f)
+    if args.report:
+        instrumentation.write_report(args.report)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+"""
+Per-stage timing and memory instrumentation for the pipeline scripts.
+
+    instrumentation = Instrumentation("generate_features_at_percent")
+    with instrumentation.stage("load_to_dataframe") as stage:
+        df = load_to_dataframe(...)
+        stage.count(files=len(files), rows=len(df))
+    instrumentation.write_report("report.json")
+
+Every stage records its wall time, CPU time (of this process and of the worker
+processes it waited for), the peak RSS so far and every count with its rate per
+second. Each script writes the report with --report.
+"""
+import contextlib
+import json
+import resource
+import sys
+import time
+from pathlib import Path
+
+# ru_maxrss is in kilobytes on Linux, in bytes on macOS
+MAXRSS_PER_MB = 2 ** 20 if sys.platform == "darwin" else 2 ** 10
+
+
+def cpu_seconds() -> float:
+    """
+    CPU time of this process and of its terminated (and waited for) children.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process, or of its largest child if that is larger.
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / MAXRSS_PER_MB
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.counts = {}
+        self.seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_mb = None
+
+    def count(self, **counts):
+        """
+        Records how many items (rows, files, targets, ...) the stage processed.
+        """
+        self.counts.update(counts)
+
+    def as_dict(self) -> dict:
+        result = {"name": self.name, "seconds": self.seconds, "cpu_seconds": self.cpu_seconds,
+                  "peak_rss_mb": self.peak_rss_mb}
+        for key, value in self.counts.items():
+            result[key] = value
+            result[f"{key}_per_second"] = value / self.seconds if self.seconds else None
+        return result
+
+
+class Instrumentation:
+    def __init__(self, script: str):
+        self.script = script
+        self.stages: list[Stage] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **counts):
+        stage = Stage(name)
+        stage.count(**counts)
+        wall, cpu = time.perf_counter(), cpu_seconds()
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.perf_counter() - wall
+            stage.cpu_seconds = cpu_seconds() - cpu
+            stage.peak_rss_mb = peak_rss_mb()
+            self.stages.append(stage)
+
+    def report(self) -> dict:
+        return {
+            "script": self.script,
+            "argv": sys.argv[1:],
+            "seconds": sum(stage.seconds for stage in self.stages),
+            "peak_rss_mb": max((stage.peak_rss_mb for stage in self.stages), default=peak_rss_mb()),
+            "stages": [stage.as_dict() for stage in self.stages],
+        }
+
+    def write_report(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.report(), indent=4))
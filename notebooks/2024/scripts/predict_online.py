@@ -0,0 +1,225 @@
+"""
+Predicts, while a modded chuffed solve is still running, whether it will finish
+within the time limit.
+
+Reads the solver's --json-stream output from stdin (or follows a file as it
+grows), samples it at every half percent of the time limit like
+generate_features_at_percent.py does, derives the same features and applies the
+model trained for that half percent as soon as it is reached. Every verdict is
+written as one JSON line:
+
+    {"percentage": 4, "search_time": 144.2, "solved_within_time_limit": false,
+     "probability": 0.12, "latency_ms": 0.9}
+
+Example:
+
+    minizinc problem.mzn --solver org.chuffed.modded-chuffed --json-stream ... \\
+        | python predict_online.py --model 4=results/target_17 --model 10=results/target_83
+
+where each directory is a cross validation output with model.pkl (and scaler.pkl
+if the target scaled its features).
+"""
+import json
+import logging
+import pickle
+import sys
+import time
+import warnings
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import sklearn
+from rich.console import Console
+from rich.logging import RichHandler
+
+from generate_features_at_percent import HalfPercentSampler, cleanup_columns, gradients_columns
+
+logger = logging.getLogger(__name__)
+
+# Snapshots with another amount of statistics are skipped, as in create_features_at_percent
+STATISTICS_PER_SNAPSHOT = 33
+LABEL = "solved_within_time_limit"
+
+
+class TrainedModel:
+    """
+    A model saved by cross_validate.py together with the scaler of its view.
+    """
+
+    def __init__(self, directory):
+        directory = Path(directory)
+        with open(directory / "model.pkl", "rb") as f:
+            self.model = pickle.load(f)
+
+        self.scaler = None
+        if (directory / "scaler.pkl").exists():
+            with open(directory / "scaler.pkl", "rb") as f:
+                self.scaler = pickle.load(f)
+
+        # Features are passed as a plain array in the order they were fit in, which
+        # skips the DataFrame construction and validation on every prediction
+        self.inputs = list(self.scaler.feature_names_in_ if self.scaler is not None else self.model.feature_names_in_)
+        self.positions = [self.inputs.index(name) for name in self.model.feature_names_in_]
+        self.positive = list(self.model.classes_).index(True) if hasattr(self.model, "classes_") else None
+
+    def predict(self, columns: dict[str, np.ndarray]):
+        """
+        Returns (solved_within_time_limit, probability) for the features of one
+        snapshot, or None if it lacks features the model needs (e.g. gradients).
+        """
+        # The scaler was fit on the view including its label, which is not known yet
+        features = np.array([[columns[name][0] if name in columns else 0 if name == LABEL else np.nan
+                              for name in self.inputs]], dtype=float)
+
+        with warnings.catch_warnings(), sklearn.config_context(assume_finite=True):
+            # Fit with feature names, predicted without
+            warnings.simplefilter("ignore", UserWarning)
+            if self.scaler is not None:
+                features = self.scaler.transform(features)
+            features = features[:, self.positions]
+            if np.isnan(features).any():
+                return None
+
+            if hasattr(self.model, "predict_proba"):
+                probability = float(self.model.predict_proba(features)[0, self.positive])
+                return probability >= 0.5, probability
+            return bool(self.model.predict(features)[0]), None
+
+
+class OnlinePredictor:
+    """
+    Incremental version of the feature pipeline for a single solve: every pushed
+    snapshot goes through a HalfPercentSampler, and every half percent it resolves
+    gets its features (and gradients over lag half percents) derived and, if there
+    is a model for it, a verdict.
+    """
+
+    def __init__(self, models: dict[int, TrainedModel], lag=1):
+        self.models = models
+        self.lag = lag
+        self.sampler = HalfPercentSampler()
+        self._columns_at_percent = {}
+        self._search_time = 0
+
+    def push(self, statistic) -> list[dict]:
+        verdicts = []
+        if statistic is not None:
+            self._search_time = statistic.get("search_time", self._search_time)
+        for percentage in self.sampler.push(statistic):
+            # Features are only derived where a model, or the gradient of one, needs them
+            if percentage not in self.models and percentage + self.lag not in self.models:
+                continue
+
+            start = time.perf_counter()
+            statistics = self.sampler.statistics_per_half_percent[percentage]
+            if len(statistics) != STATISTICS_PER_SNAPSHOT:
+                continue
+
+            # Same derivation as create_features_at_percent, on a single row
+            columns = cleanup_columns({key: np.array([value]) for key, value in statistics.items()})
+            if percentage >= self.lag:
+                columns_prev = self._columns_at_percent.get(percentage - self.lag, {})
+                columns = gradients_columns(columns_prev, columns, np.array([0 if columns_prev else -1]))
+
+            self._columns_at_percent[percentage] = columns
+            self._columns_at_percent.pop(percentage - self.lag, None)
+
+            if percentage not in self.models:
+                continue
+            prediction = self.models[percentage].predict(columns)
+            if prediction is None:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("missing features for the model at %d", percentage)
+                continue
+
+            solved_within_time_limit, probability = prediction
+            verdicts.append({
+                "percentage": percentage,
+                "search_time": statistics["search_time"],
+                "solved_within_time_limit": bool(solved_within_time_limit),
+                "probability": probability,
+                "latency_ms": (time.perf_counter() - start) * 1000,
+            })
+        return verdicts
+
+    def done(self):
+        """
+        Whether the solve is past the last half percent there is a model for.
+        """
+        return self.sampler.time_at_percent(max(self.models)) < self._search_time
+
+
+def follow(path: Path, poll_interval=0.2):
+    """
+    Yields the lines of a file that is still being written, until the solver's
+    final status line.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        partial = ""
+        while True:
+            line = f.readline()
+            if not line:
+                time.sleep(poll_interval)
+                continue
+            partial += line
+            if not partial.endswith("\n"):
+                continue
+            line, partial = partial, ""
+            yield line
+            if '"status"' in line and json.loads(line).get("type") == "status":
+                return
+
+
+def parse_model(argument: str):
+    percentage, directory = argument.split("=", 1)
+    return int(percentage), Path(directory)
+
+
+def main():
+    parser = ArgumentParser(description="Predict whether a running solve will finish within the time limit")
+    parser.add_argument(
+        "--model",
+        type=parse_model,
+        action="append",
+        required=True,
+        help="PERCENT=DIR: apply the model in cross validation output DIR at half percent PERCENT "
+             "(the percentage of the feature store). Can be repeated.",
+    )
+    parser.add_argument(
+        "--input",
+        type=Path,
+        help="json-stream file to follow while it is written (default: read stdin)",
+    )
+    parser.add_argument(
+        "--lag",
+        type=int,
+        default=1,
+        help="Amount of timesteps for the lag of the gradient, as used for the features of the models",
+    )
+    parser.add_argument(
+        "--stop_when_done",
+        action="store_true",
+        help="Exit after the verdict of the last model instead of reading until the end of the output",
+    )
+    args = parser.parse_args()
+
+    # Verdicts go to stdout, so logs go to stderr
+    logging.basicConfig(level="NOTSET", format="%(message)s", datefmt="[%X]",
+                        handlers=[RichHandler(console=Console(stderr=True))], force=True)
+
+    predictor = OnlinePredictor({percentage: TrainedModel(directory) for percentage, directory in args.model},
+                                args.lag)
+    lines = follow(args.input) if args.input else sys.stdin
+
+    for line in lines:
+        if not line.strip():
+            continue
+        for verdict in predictor.push(json.loads(line).get("statistics")):
+            print(json.dumps(verdict), flush=True)
+        if args.stop_when_done and predictor.done():
+            break
+
+
+if __name__ == "__main__":
+    main()
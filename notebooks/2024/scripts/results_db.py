@@ -0,0 +1,202 @@
+"""
+SQLite database of cross validation results, so the analysis loads every seed
+of an experiment with one query instead of opening a data.json (and its
+original target) per target. The main process of cross_validate.py and
+run_experiment.py writes every result as it comes in (data.json and model.pkl
+are still written next to the model):
+
+    results          one row per target and run: experiment, run, seed, target_hash,
+                     target_path, percentage, model, use_gradient, use_ewma,
+                     hyperparameters / preprocessing / k_fold (JSON), model_path, scaler_path
+    fold_scores      result_id, fold, f1_score
+    problem_scores   result_id, fold, problem, length, correct (fold is NULL for results
+                     from before per_problem recorded the fold of every score)
+
+Results written before there was a database are imported with
+
+    python results_db.py import RESULTS.sqlite CROSS_VALIDATIONS_DIR --experiment base-experiment --run 1
+"""
+import argparse
+import json
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+
+from run_ledger import target_hash
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    experiment TEXT,
+    run INTEGER,
+    seed INTEGER,
+    target_hash TEXT,
+    target_path TEXT,
+    percentage INTEGER,
+    model TEXT,
+    use_gradient INTEGER,
+    use_ewma INTEGER,
+    hyperparameters TEXT,
+    preprocessing TEXT,
+    k_fold TEXT,
+    model_path TEXT,
+    scaler_path TEXT,
+    UNIQUE (experiment, run, target_hash)
+);
+CREATE INDEX IF NOT EXISTS results_by_view ON results (experiment, run, percentage, model);
+CREATE TABLE IF NOT EXISTS fold_scores (
+    result_id INTEGER REFERENCES results (id),
+    fold INTEGER,
+    f1_score REAL,
+    PRIMARY KEY (result_id, fold)
+);
+CREATE TABLE IF NOT EXISTS problem_scores (
+    result_id INTEGER REFERENCES results (id),
+    fold INTEGER,
+    problem TEXT,
+    length INTEGER,
+    correct REAL
+);
+CREATE INDEX IF NOT EXISTS problem_scores_by_result ON problem_scores (result_id);
+"""
+
+
+def _where(experiment=None, runs=None) -> tuple[str, list]:
+    conditions, parameters = [], []
+    if experiment is not None:
+        conditions.append("r.experiment = ?")
+        parameters.append(experiment)
+    if runs is not None:
+        runs = list(runs)
+        conditions.append(f"r.run IN ({', '.join('?' * len(runs))})")
+        parameters += runs
+    return (" WHERE " + " AND ".join(conditions)) if conditions else "", parameters
+
+
+class ResultsDatabase:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def record(self, records: list[dict], experiment, run=None, seed=None):
+        """
+        Writes the results of targets, as ledger records (see run_ledger.py) that
+        carry the target and its result (see cross_validate.run_per_view). A target
+        recorded before for the same experiment and run is replaced.
+        """
+        with self.connection:
+            for record in records:
+                target, result = record["target"], record["result"]
+                key = target_hash(record["target_path"], target)
+                self.connection.execute(
+                    "DELETE FROM fold_scores WHERE result_id IN "
+                    "(SELECT id FROM results WHERE experiment = ? AND run IS ? AND target_hash = ?)",
+                    (experiment, run, key))
+                self.connection.execute(
+                    "DELETE FROM problem_scores WHERE result_id IN "
+                    "(SELECT id FROM results WHERE experiment = ? AND run IS ? AND target_hash = ?)",
+                    (experiment, run, key))
+                self.connection.execute(
+                    "DELETE FROM results WHERE experiment = ? AND run IS ? AND target_hash = ?",
+                    (experiment, run, key))
+
+                result_id = self.connection.execute(
+                    "INSERT INTO results (experiment, run, seed, target_hash, target_path, percentage, model, "
+                    "use_gradient, use_ewma, hyperparameters, preprocessing, k_fold, model_path, scaler_path) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (experiment, run, seed, key, str(record["target_path"]), target["percentage"], target["model"],
+                     target["use_gradient"], target["use_ewma"], json.dumps(target["hyperparameters"]),
+                     json.dumps(target.get("preprocessing")), json.dumps(target.get("k_fold")),
+                     result.get("model_path"), result.get("scaler_path"))).lastrowid
+
+                self.connection.executemany(
+                    "INSERT INTO fold_scores (result_id, fold, f1_score) VALUES (?, ?, ?)",
+                    [(result_id, fold, score) for fold, score in enumerate(result["f1_scores"])])
+                self.connection.executemany(
+                    "INSERT INTO problem_scores (result_id, fold, problem, length, correct) VALUES (?, ?, ?, ?, ?)",
+                    [(result_id, score.get("fold"), problem, score["length"], score["correct"])
+                     for problem, scores in result.get("per_problem", {}).items()
+                     for score in scores])
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_results(path, experiment=None, runs=None) -> pd.DataFrame:
+    """
+    One row per fold of every result (of an experiment and some runs), in the shape
+    the analysis notebooks used to build from the data.json files: indexed by
+    percentage, model, use_gradient and use_ewma, with a column per hyperparameter,
+    f1_score and model_path, plus the run, seed and fold.
+    """
+    where, parameters = _where(experiment, runs)
+    with sqlite3.connect(path) as connection:
+        rows = pd.read_sql_query(
+            "SELECT r.run, r.seed, r.percentage, r.model, r.use_gradient, r.use_ewma, r.hyperparameters, "
+            "r.model_path, f.fold, f.f1_score FROM results r JOIN fold_scores f ON f.result_id = r.id"
+            + where + " ORDER BY r.id, f.fold", connection, params=parameters)
+
+    # Every result repeats its hyperparameters on each fold, so each distinct one is decoded once
+    hyperparameters = pd.DataFrame.from_records(
+        [json.loads(value) for value in rows["hyperparameters"].unique()], index=rows["hyperparameters"].unique())
+    results = pd.concat([rows.drop(columns=["hyperparameters"]),
+                         hyperparameters.reindex(rows["hyperparameters"]).reset_index(drop=True)], axis=1)
+    results["use_gradient"] = results["use_gradient"].astype(bool)
+    results["use_ewma"] = results["use_ewma"].astype(bool)
+    return results.set_index(["percentage", "model", "use_gradient", "use_ewma"])
+
+
+def load_problem_scores(path, experiment=None, runs=None) -> pd.DataFrame:
+    """
+    The fraction of correct predictions per problem and fold of every result.
+    """
+    where, parameters = _where(experiment, runs)
+    with sqlite3.connect(path) as connection:
+        return pd.read_sql_query(
+            "SELECT r.run, r.seed, r.percentage, r.model, r.use_gradient, r.use_ewma, r.hyperparameters, "
+            "p.fold, p.problem, p.length, p.correct FROM results r JOIN problem_scores p ON p.result_id = r.id"
+            + where + " ORDER BY r.id, p.fold", connection, params=parameters)
+
+
+def import_outputs(database: ResultsDatabase, output_path, experiment, run=None, seed=None) -> int:
+    """
+    Records the data.json files of a cross validation output directory, with the
+    hyperparameters from their original targets. Returns the number imported.
+    """
+    records = []
+    for result_path in sorted(Path(output_path).glob("*/data.json")):
+        result = json.loads(result_path.read_text())
+        target_path = result["original_target"]
+        records.append(dict(target_path=target_path, target=json.loads(Path(target_path).read_text()), result=result))
+    database.record(records, experiment, run, seed)
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Results database of the cross validations")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    importer = subparsers.add_parser("import", help="Import the data.json files of a cross validation output directory")
+    importer.add_argument("database", type=Path)
+    importer.add_argument("output", type=Path, help="Output directory of cross_validate.py")
+    importer.add_argument("--experiment", required=True, help="Name of the experiment, e.g. base-experiment")
+    importer.add_argument("--run", type=int, help="Run of the experiment (the seed number in the notebooks)")
+    importer.add_argument("--seed", type=int, help="Random seed of the train/test split")
+    args = parser.parse_args()
+
+    with ResultsDatabase(args.database) as database:
+        imported = import_outputs(database, args.output, args.experiment, args.run, args.seed)
+    print(f"Imported {imported} results into {args.database}")
+
+
+if __name__ == "__main__":
+    main()
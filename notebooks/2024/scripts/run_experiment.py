@@ -0,0 +1,176 @@
+"""
+Runs a whole experiment (every seed of a train/test split, cross validated on
+every target) in one process: the features and the targets are read once and
+all (run x view) jobs share one worker pool. An experiment is described by a
+JSON config:
+
+    {
+        "experiment": "base-experiment",
+        "features": "analysis/paper-data/all_features.pkl",
+        "targets": "analysis/paper-data/targets_full",
+        "split": {"method": "stratified", "test_size": 0.1},
+        "runs": [{"run": 1, "seed": 601}, {"run": 2, "seed": 602}],
+        "splits": "analysis/paper-data/base-experiment-{seed}",
+        "output": "analysis/paper-data/cross-validations-base-experiment-{run}",
+        "results": "analysis/paper-data/results.sqlite",
+        "warm_start_sweep": false
+    }
+
+The split method is "stratified" (generate_pickles_for_base_experiment.py) or
+"problem_class" (generate_pickles_for_problem_class_ablation.py). The split
+manifests of every run are written to splits (see feature_store.save_split) and
+the cross validations of its train set to output, as cross_validate.py does.
+Every result is recorded in the results database (see results_db.py) under the
+experiment, run and seed.
+Targets the ledger of their output directory has as done (see run_ledger.py)
+are skipped, so an interrupted experiment resumes.
+
+    python scripts/run_experiment.py experiments/base_experiment.json
+"""
+import contextlib
+import functools
+import json
+import logging
+import multiprocessing
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+
+from rich import progress
+
+import cross_validate
+import generate_pickles_for_base_experiment as base_experiment
+import generate_pickles_for_problem_class_ablation as problem_class_ablation
+from feature_store import (FINGERPRINT_COLUMNS, MappedFeatures, SplitFeatures, fingerprint, is_pickle, load_features,
+                           save_split, write_feature_store)
+from instrumentation import Instrumentation
+from results_db import ResultsDatabase
+from run_ledger import RunLedger
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PERCENTAGES = range(1, 41)
+SPLIT_COLUMNS = {
+    "stratified": ["solved_within_time_limit"],
+    "problem_class": ["mzn"],
+}
+
+
+def split_positions(split, features_at_percent, seed):
+    """
+    The row positions of the train and the test set per percentage, for one seed.
+    """
+    if split["method"] == "stratified":
+        return base_experiment.split_into_train_and_test(features_at_percent, random_state=seed,
+                                                         test_size=split.get("test_size", 0.1))
+    if split["method"] == "problem_class":
+        test_problems = problem_class_ablation.split_problems(problem_class_ablation.problem_counts(features_at_percent),
+                                                              percentage_split=split.get("test_size", 0.2),
+                                                              random_state=seed)
+        return problem_class_ablation.split_into_train_and_test(features_at_percent, test_problems)
+    raise ValueError(f"Unsupported split method: {split['method']}")
+
+
+def run_job(job, warm_start_sweep=False):
+    targets, output_path, run, train_data = job
+    return output_path, run, cross_validate.run_per_view(targets, output_path, train_data, warm_start_sweep)
+
+
+def main():
+    """
+    Splits the features for every run of an experiment and cross validates them.
+    """
+    parser = ArgumentParser(description="Run every seed of an experiment in one process")
+    parser.add_argument(
+        "config",
+        type=Path,
+        help="JSON file describing the experiment",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="Worker processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="JSON file to write the time, CPU time, peak memory and throughput of every stage to",
+    )
+    args = parser.parse_args()
+
+    config = json.loads(args.config.read_text())
+    split = config["split"]
+    if split["method"] not in SPLIT_COLUMNS:
+        parser.error(f"Unsupported split method: {split['method']}")
+    features_path = Path(config["features"])
+    instrumentation = Instrumentation(Path(__file__).stem)
+
+    with instrumentation.stage("load_targets") as stage:
+        views = cross_validate.group_targets(Path(config["targets"]).glob("*.json"))
+        stage.count(targets=sum(len(view) for view in views), views=len(views))
+
+    with contextlib.ExitStack() as stack:
+        # Workers share the features through the memory-mapped feature store, a pickle is
+        # spilled to a temporary store once for all runs
+        with instrumentation.stage("load_features") as stage:
+            if is_pickle(features_path) or features_path.is_file():
+                features_at_percent = load_features(features_path, percentages=PERCENTAGES)
+                store_path = Path(stack.enter_context(tempfile.TemporaryDirectory(dir=features_path.parent)))
+                write_feature_store(features_at_percent, store_path, downcast=False)
+            else:
+                columns = SPLIT_COLUMNS[split["method"]]
+                features_at_percent = load_features(features_path, percentages=PERCENTAGES,
+                                                    columns=columns + [column for column in FINGERPRINT_COLUMNS
+                                                                       if column not in columns])
+                store_path = features_path
+            features = MappedFeatures(store_path)
+            fingerprints = {percentage: fingerprint(df) for percentage, df in features_at_percent.items()}
+            stage.count(rows=sum(len(df) for df in features_at_percent.values()))
+
+        jobs, ledgers, skipped = [], {}, 0
+        with instrumentation.stage("split", runs=len(config["runs"])):
+            for run in config["runs"]:
+                train, test = split_positions(split, features_at_percent, run["seed"])
+                splits = config["splits"].format(**run)
+                save_split(f"{splits}_train.npz", features_path, train, fingerprints)
+                save_split(f"{splits}_test.npz", features_path, test, fingerprints)
+
+                output_path = Path(config["output"].format(**run))
+                output_path.mkdir(parents=True, exist_ok=True)
+                ledgers[output_path] = stack.enter_context(RunLedger(output_path))
+                run_views, run_skipped = cross_validate.pending_views(views, output_path, ledgers[output_path])
+                skipped += run_skipped
+                for view in run_views:
+                    # Only the positions at the view's percentage travel with the job
+                    percentage = view[0][1]['percentage']
+                    train_data = SplitFeatures(features, {percentage: train[percentage]},
+                                               {percentage: fingerprints[percentage]})
+                    jobs.append((view, output_path, run, train_data))
+        del features_at_percent
+
+        # Sorted by view (percentage first) across the runs, see cross_validate.view_chunksize
+        jobs.sort(key=lambda job: cross_validate.view_key(job[0][0][1]))
+        total = sum(len(job[0]) for job in jobs)
+        results = stack.enter_context(ResultsDatabase(config["results"]))
+
+        with instrumentation.stage("cross_validate", targets=total, jobs=len(jobs)):
+            with multiprocessing.Pool(args.processes) as pool:
+                with progress.Progress(expand=True) as pbar:
+                    task = pbar.add_task("[red]Cross validating...", total=total + skipped, completed=skipped)
+                    for output_path, run, records in pool.imap_unordered(functools.partial(
+                            run_job, warm_start_sweep=config.get("warm_start_sweep", False)), jobs,
+                            chunksize=cross_validate.view_chunksize(jobs, args.processes)):
+                        ledgers[output_path].record(records)
+                        results.record([record for record in records if record["status"] == "done"],
+                                       config["experiment"], run["run"], run["seed"])
+                        pbar.advance(task, len(records))
+
+    logger.info("Cross validated %d targets over %d runs, %d were done already", total, len(config["runs"]), skipped)
+
+    if args.report:
+        instrumentation.write_report(args.report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Ledger of the cross validated targets, so an interrupted sweep resumes where it
+stopped. It is a SQLite database in the output directory with one row per
+target:
+
+    target_hash   sha1 of the target file name and its contents
+    target_path   the target file
+    status        done or failed
+    started       unix time the target was started
+    seconds       time it took to cross validate (the whole sweep for a sweep)
+    result_path   data.json of the target
+    model_path    model.pkl of the target
+    error         why it failed
+
+Only the main process writes to the ledger, one transaction per view as its
+results come in, so a crash costs at most the views in flight. Failed targets
+are tried again on the next run. A target keeps one row: recording it replaces
+the rows of its previous contents.
+"""
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+
+LEDGER = "ledger.sqlite"
+COLUMNS = ("target_hash", "target_path", "status", "started", "seconds", "result_path", "model_path", "error")
+
+
+def target_hash(target_path, target: dict) -> str:
+    """
+    Targets are keyed by their file name (which names their output directory) and
+    their contents, so a changed target is cross validated again.
+    """
+    key = json.dumps([Path(target_path).stem, target], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class RunLedger:
+    def __init__(self, output_path):
+        self.path = Path(output_path) / LEDGER
+        self.connection = sqlite3.connect(self.path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS targets ("
+                "target_hash TEXT PRIMARY KEY, target_path TEXT, status TEXT, started REAL, seconds REAL, "
+                "result_path TEXT, model_path TEXT, error TEXT)"
+            )
+        self._done = set()
+        self._hashes: dict[str, set[str]] = {}
+        for key, path, status in self.connection.execute("SELECT target_hash, target_path, status FROM targets"):
+            self._hashes.setdefault(Path(path).stem, set()).add(key)
+            if status == "done":
+                self._done.add(key)
+
+    def is_done(self, target_hash: str) -> bool:
+        return target_hash in self._done
+
+    def has_target(self, target_path) -> bool:
+        """
+        Whether the ledger has a row for the target, with any contents.
+        """
+        return Path(target_path).stem in self._hashes
+
+    def record(self, records: list[dict]):
+        """
+        Records the outcome of targets, as dicts with (a subset of) COLUMNS.
+        """
+        stale = []
+        for record in records:
+            hashes = self._hashes.setdefault(Path(record["target_path"]).stem, set())
+            stale += [key for key in hashes if key != record["target_hash"]]
+            hashes.clear()
+            hashes.add(record["target_hash"])
+        with self.connection:
+            self.connection.executemany("DELETE FROM targets WHERE target_hash = ?", [(key,) for key in stale])
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO targets ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                [tuple(record.get(column) for column in COLUMNS) for record in records],
+            )
+        self._done.difference_update(stale)
+        self._done.update(record["target_hash"] for record in records if record["status"] == "done")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,6 +1,8 @@
 rule download_all_problems:
     output:
         temp(directory(f"{config['base_dir']}/temp/problems")),
+    params:
+        cache_dir=config.get("download_cache", f"{config['base_dir']}/cache/downloads"),
     conda:
         "../envs/download-convert-problems.yaml"
     threads: workflow.cores
@@ -13,6 +15,7 @@ rule convert_cnf_problems:
         f"{config['base_dir']}/temp/problems/",
     output:
         temp(directory(f"{config['base_dir']}/temp/converted_satlib/")),
+    threads: workflow.cores
     script:
         "../scripts/convert_cnf.py"
 
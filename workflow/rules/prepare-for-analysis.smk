@@ -5,6 +5,8 @@ include: "solve-problems.smk"
 rule create_features_at_percentile:
     input:
         lambda wildcards: checkpoints.solve_all_problems.get(**wildcards).output[0]
-    output: f"{config['base_dir']}/resources/features_at_percentiles.pkl"
+    output: directory(f"{config['base_dir']}/resources/features_at_percentiles")
     threads: workflow.cores
-    shell: "python workflow/scripts/output_to_features_at_percent.py --input_dir {input} --output_filename {output} --num_processes {threads}"
\ No newline at end of file
+    params:
+        cache_dir=config.get("feature_cache", f"{config['base_dir']}/cache/features")
+    shell: "python notebooks/2024/scripts/generate_features_at_percent.py --input_dir {input} --output_filename {output} --num_processes {threads} --cache_dir {params.cache_dir}"
\ No newline at end of file
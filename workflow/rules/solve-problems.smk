@@ -9,6 +9,10 @@ def get_mem_mb(wildcards, attempt):
     return (attempt * 1000) + 1500
 
 
+# Extra options for save_solver_output.py (and solve_batch.py), e.g. "--mode time --compress" or "--format binary"
+SOLVER_OUTPUT_OPTIONS = config.get("solver_output_options", "")
+
+
 rule solve_problem_normal_chuffed:
     input:
         f"{config['base_dir']}/resources/problems_compiled/{{fzn_file}}.fzn",
@@ -28,7 +32,7 @@ rule solve_problem_normal_chuffed:
         stdout=f"{config['base_dir']}/log/solve/stdout/{{fzn_file}}-OUTPUT-NORMAL.log",
         stderr=f"{config['base_dir']}/log/solve/stderr/{{fzn_file}}-OUTPUT-NORMAL.log",
     shell:
-        "(minizinc {input} --solver org.chuffed.chuffed -t 7200000 --json-stream --output-time -r 42 | python3 workflow/scripts/save_solver_output.py {output}) > {log.stdout} 2>{log.stderr}"
+        "(minizinc {input} --solver org.chuffed.chuffed -t 7200000 --json-stream --output-time -r 42 | python3 workflow/scripts/save_solver_output.py {output} " + SOLVER_OUTPUT_OPTIONS + ") > {log.stdout} 2>{log.stderr}"
 
 
 rule solve_problem_stats_chuffed:
@@ -48,11 +52,50 @@ rule solve_problem_stats_chuffed:
         stdout=f"{config['base_dir']}/log/solve/stdout/{{fzn_file}}-OUTPUT-STATS.log",
         stderr=f"{config['base_dir']}/log/solve/stderr/{{fzn_file}}-OUTPUT-STATS.log",
     shell:
-        "(minizinc {input} --solver org.chuffed.modded-chuffed -t 7200000 --json-stream --output-time -r 42 | python3 workflow/scripts/save_solver_output.py {output}) > {log.stdout} 2>{log.stderr}"
+        "(minizinc {input} --solver org.chuffed.modded-chuffed -t 7200000 --json-stream --output-time -r 42 | python3 workflow/scripts/save_solver_output.py {output} " + SOLVER_OUTPUT_OPTIONS + ") > {log.stdout} 2>{log.stderr}"
+
+
+SOLVER_BATCHES = config.get("solver_batches", workflow.cores)
+
+
+rule solve_problem_batch:
+    """
+    Batched alternative to the two rules above (enable with batched_solver in the
+    config): every batch job solves its share of the problems with both solvers,
+    one after another, in a single container. With paired_solver both solvers run
+    side by side, so the job takes two threads: NORMAL must not share its core,
+    its wall time is what the problems are labelled with.
+    """
+    input:
+        lambda wildcards: checkpoints.compile_all_problems.get(**wildcards).output[0],
+    output:
+        f"{config['base_dir']}/temp/problem_output_batches/batch-{{batch}}.done",
+    conda:
+        "../envs/solve_problem.yaml"
+    container:
+        f"{config['base_dir']}/containers/solve_problem.sif"
+    resources:
+        mem_mb=get_mem_mb
+    log:
+        f"{config['base_dir']}/log/solve/batch-{{batch}}.log",
+    threads: 2 if config.get("paired_solver") else 1
+    shell:
+        f"python3 workflow/scripts/solve_batch.py {{input}} {config['base_dir']}/temp/problem_output "
+        f"--batch {{wildcards.batch}} --batches {SOLVER_BATCHES} "
+        f"--benchmark_dir {config['base_dir']}/benchmarks/solve "
+        f"--log_dir {config['base_dir']}/log/solve/stderr "
+        f"{'--paired ' if config.get('paired_solver') else ''}"
+        f"{SOLVER_OUTPUT_OPTIONS} "
+        "--done {output} > {log} 2>&1"
 
 
 def list_all_output_files(wildcards):
     checkpoint_output = checkpoints.compile_all_problems.get(**wildcards).output[0]
+    if config.get("batched_solver", False):
+        return expand(
+            f"{config['base_dir']}/temp/problem_output_batches/batch-{{batch}}.done",
+            batch=range(SOLVER_BATCHES),
+        )
     fzns = glob_wildcards(f"{checkpoint_output}/{{fzn}}.fzn").fzn
     return expand(
         f"{config['base_dir']}/temp/problem_output/{{fzn}}-OUTPUT-{{version}}.json",
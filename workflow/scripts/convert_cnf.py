@@ -1,63 +1,65 @@
+import functools
+import multiprocessing
 from pathlib import Path
 from rich.progress import track
 
+WRITE_BUFFER_SIZE = 1 << 20
 
-def convert(file):
+
+def convert(file, output_file):
+    """
+    Streams a DIMACS CNF file into a MiniZinc model, one clause() constraint per
+    CNF clause, e.g. "1 -3 0" becomes "constraint clause([b[1]],[b[3]]);".
+    """
     file_type = None
     variables = -1
     clauses = -1
 
-    lines = []
-    current_clause = 'constraint '
+    positive, negative = [], []
 
-    with open(file, 'r', encoding='utf8') as cnf_file:
+    with open(file, 'r', encoding='utf8') as cnf_file, \
+            open(output_file, 'w', encoding='utf8', buffering=WRITE_BUFFER_SIZE) as minizinc_file:
         for line in cnf_file:
             if line[0] == 'p':
                 file_type, variables, clauses = line.strip().split()[1:]
                 variables = int(variables)
                 clauses = int(clauses)
                 assert file_type == 'cnf' and variables > 0 and clauses > 0
-                array_def = f'array[1..{variables}] of var bool: b;'
-                lines.append(array_def)
+                minizinc_file.write(f'array[1..{variables}] of var bool: b;\n')
             elif line[0] == 'c' or line[0] == '%':
                 pass  # skip comments
             else:
-                for var in line.strip().split():
+                for var in line.split():
                     var = int(var)
                     if var == 0:
-                        if current_clause != 'constraint ':
-                            current_clause += ';'
-                            lines.append(current_clause)
-                            current_clause = 'constraint '
+                        if positive or negative:
+                            minizinc_file.write(f"constraint clause([{','.join(positive)}],[{','.join(negative)}]);\n")
+                            positive, negative = [], []
                     elif var < 0:   # ! var
-                        var = abs(var)
-                        if current_clause == 'constraint ':
-                            current_clause += f'b[{var}] = false'
-                        else:
-                            current_clause += f' \/ b[{var}] = false'
+                        negative.append(f'b[{-var}]')
                     else:           # var
-                        if current_clause == 'constraint ':
-                            current_clause += f'b[{var}] = true'
-                        else:
-                            current_clause += f' \/ b[{var}] = true'
-    lines.append('solve satisfy;')
+                        positive.append(f'b[{var}]')
+        minizinc_file.write('solve satisfy;')
+
 
-    return lines
+def convert_to(file, output_path: Path):
+    convert(file, output_path / f"{file.stem}.mzn")
 
 
-def process_files(input_path: Path, output_path: Path):
+def process_files(input_path: Path, output_path: Path, processes=1):
     output_path.mkdir(exist_ok=True)
-    for file in track(input_path.glob('./**/*.cnf')):
-        converted_problem = convert(file)
+    files = list(input_path.glob('./**/*.cnf'))
 
-        with open(output_path / f"{file.stem}.mzn", 'w', encoding='utf8') as minizinc_file:
-            minizinc_file.writelines('\n'.join(converted_problem))
+    with multiprocessing.Pool(max(1, processes)) as pool:
+        for _ in track(pool.imap_unordered(functools.partial(convert_to, output_path=output_path), files),
+                       total=len(files)):
+            pass
 
 
 def main():
     cnf_folder = Path(str(snakemake.input))
     output_folder = Path(str(snakemake.output))
-    process_files(cnf_folder, output_folder)
+    process_files(cnf_folder, output_folder, snakemake.threads)
 
 
 if __name__ == "__main__":
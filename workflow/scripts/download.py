@@ -1,8 +1,11 @@
 import glob
+import hashlib
+import json
 import os
 import shutil
 import tarfile
-from io import BytesIO
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.request import urlopen
 from zipfile import ZipFile
@@ -14,16 +17,7 @@ from bs4 import BeautifulSoup
 import requests
 
 # problem sources
-# Scrape SATLIB Links
-base_url = 'https://www.cs.ubc.ca/~hoos/SATLIB/'
-res = requests.get(base_url + '/benchm.html', timeout=5)
-soup = BeautifulSoup(res.text, 'html.parser')
-
-SATLIB_LINKS = [
-    base_url + '/' + link.get('href')
-    for link in soup.find_all('a')
-    if link.get('href')[-7:] == '.tar.gz'
-]
+SATLIB_BASE_URL = 'https://www.cs.ubc.ca/~hoos/SATLIB/'
 
 CHALLENGE_LIST = [
     f"https://www.minizinc.org/challenge{year}/mznc{year}-probs.tar.gz"
@@ -35,46 +29,114 @@ CHALLENGE_LIST = [
 MINIZINC_BENCHMARK = 'https://github.com/MiniZinc/minizinc-benchmarks/archive/refs/heads/master.zip'
 MIPLIB_CURATED = 'https://drive.google.com/uc?id=1n0RZLUdFBW4Nhmdwj02VqW_gG6s8S8I8&confirm=t'
 
+CHUNK_SIZE = 1 << 20
+
+
+def satlib_links(base_url=SATLIB_BASE_URL):
+    # Scrape SATLIB Links
+    res = requests.get(base_url + '/benchm.html', timeout=5)
+    soup = BeautifulSoup(res.text, 'html.parser')
+
+    return [
+        base_url + '/' + link.get('href')
+        for link in soup.find_all('a')
+        if link.get('href')[-7:] == '.tar.gz'
+    ]
+
+
+def fetch_url(url, destination: Path):
+    with urlopen(url) as res, open(destination, 'wb') as file:
+        shutil.copyfileobj(res, file, CHUNK_SIZE)
+
+
+def fetch_google_drive(url, destination: Path):
+    gdown.download(url, str(destination))
+
+
+def sha256_of(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_download(url, cache_dir: Path, fetch=fetch_url) -> Path:
+    """
+    Downloads url into a content-addressed cache and returns the cached file.
+
+    Archives are stored as <sha256>.archive, next to a small record per url
+    (named by the hash of the url) pointing to its content. A cached archive is
+    checked against its hash before it is reused and downloaded again if it
+    does not match.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    record_path = cache_dir / f"{hashlib.sha256(url.encode()).hexdigest()}.json"
+
+    if record_path.exists():
+        record = json.loads(record_path.read_text())
+        archive = cache_dir / f"{record['sha256']}.archive"
+        if archive.exists() and sha256_of(archive) == record['sha256']:
+            print(f"Using cached {url}")
+            return archive
+        print(f"Cached {url} is missing or corrupt, downloading again")
 
-def download_extract(url, archive_type, location):
     print(f"Downloading {url}")
-    res = urlopen(url)
-    bytes_read = BytesIO(res.read())
-    print("Extracting...")
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.part', delete=False) as part:
+        part_path = Path(part.name)
+    try:
+        fetch(url, part_path)
+        sha256 = sha256_of(part_path)
+        archive = cache_dir / f"{sha256}.archive"
+        os.replace(part_path, archive)
+    finally:
+        part_path.unlink(missing_ok=True)
+
+    record_path.write_text(json.dumps({'url': url, 'sha256': sha256, 'size': archive.stat().st_size}))
+    return archive
+
+
+def extract(archive: Path, archive_type, location):
+    """
+    Extracts an archive straight from disk, members are streamed one at a time.
+    """
+    print(f"Extracting {archive}...")
     match archive_type:
         case "tar":
-            file = tarfile.open(fileobj=bytes_read)
-            file.extractall(location)
+            with tarfile.open(archive) as file:
+                file.extractall(location)
         case "zip":
-            file = ZipFile(bytes_read)
-            file.extractall(location)
+            with ZipFile(archive) as file:
+                file.extractall(location)
         case _:
             raise ValueError(
                 f"archive_type expected 'tar' or 'zip', got {archive_type}.")
     print("Extracted...")
 
 
-def download_archives_and_extract(problems_dir: Path):
-    for challenge_url in track(CHALLENGE_LIST, description="Challenges"):
-        download_extract(challenge_url, "tar", problems_dir)
-
-    print("Minizinc Benchmarks")
-    download_extract(MINIZINC_BENCHMARK, "zip", problems_dir)
+def download_archives_and_extract(problems_dir: Path, cache_dir: Path, threads=1,
+                                  challenge_urls=CHALLENGE_LIST, benchmark_url=MINIZINC_BENCHMARK,
+                                  miplib_url=MIPLIB_CURATED, miplib_fetch=fetch_google_drive):
+    """
+    Downloads all problem archives concurrently into the cache, then extracts them
+    in a fixed order so that overlapping files always end up the same.
+    """
+    downloads = [(url, "tar", problems_dir, fetch_url) for url in challenge_urls]
+    downloads.append((benchmark_url, "zip", problems_dir, fetch_url))
 
-    # for satlib_url in track(SATLIB_LINKS, description='SATLIB Problems'):
-    #     download_extract(satlib_url, "tar", problems_dir / 'satlib' / 'cnf')
+    # for satlib_url in satlib_links():
+    #     downloads.append((satlib_url, "tar", problems_dir / 'satlib' / 'cnf', fetch_url))
 
-    print("Downloading MIPLIB Problems")
-    miplib_filename = problems_dir / "../miplib.zip"
-    gdown.download(MIPLIB_CURATED, str(miplib_filename))
+    downloads.append((miplib_url, "zip", problems_dir / "miplib", miplib_fetch))
 
-    print("Extracting MIPLIB Problems")
-    with open(miplib_filename, "rb") as miplib_file:
-        file = ZipFile(BytesIO(miplib_file.read()))
-        file.extractall(problems_dir / "miplib")
-    print("Extracted MIPLIB Problems")
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        archives = list(executor.map(
+            lambda download: cached_download(download[0], cache_dir, download[3]), downloads
+        ))
 
-    os.remove(miplib_filename)
+    for archive, (url, archive_type, location, _) in track(zip(archives, downloads), total=len(downloads),
+                                                          description="Extracting problems"):
+        extract(archive, archive_type, location)
 
 
 def move_all_problems(problems_dir: Path):
@@ -107,8 +169,9 @@ def move_dzn_to_data_dirs(problems_dir: Path):
 def main():
 
     problems_dir = Path(str(snakemake.output))
+    cache_dir = Path(str(snakemake.params.cache_dir))
 
-    download_archives_and_extract(problems_dir)
+    download_archives_and_extract(problems_dir, cache_dir, snakemake.threads)
 
     move_all_problems(problems_dir)
 
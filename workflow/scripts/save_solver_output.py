@@ -1,23 +1,158 @@
 """
-Writes every Nth line to the file passed as
-a command line argument.
+Saves the json-stream output of a solver, read from stdin, to the file passed as
+a command line argument. Either every Nth line is kept, or (--mode time) only the
+lines around every interval of search_time, see TimeSampler. The lines are
+written as they are, or (--format binary) as a binary trace.
 """
 import argparse
+import gzip
+import io
 import sys
 from pathlib import Path
 
-parser = argparse.ArgumentParser()
-parser.add_argument("outfile_path", type=Path)
-parser.add_argument("--N", type=int,
-    help="Write every N lines", default=100)
-args = parser.parse_args()
+TIME_LIMIT = 7200  # seconds
+WRITE_BUFFER_SIZE = 1 << 20
+SEARCH_TIME = '"search_time":'
 
-N = args.N
 
-outfile_path = Path(args.outfile_path)
-outfile_path.parent.mkdir(exist_ok=True, parents=True)
+def search_time_of(line: str):
+    """
+    The search_time of a statistics line, without decoding the whole line.
+    """
+    start = line.find(SEARCH_TIME)
+    if start == -1:
+        return None
+    start += len(SEARCH_TIME)
+    end = start
+    while end < len(line) and line[end] not in ",}":
+        end += 1
+    try:
+        return float(line[start:end])
+    except ValueError:
+        return None
 
-with open(outfile_path, 'w', encoding='utf-8') as outfile:
-    for i, line in enumerate(sys.stdin):
-        if i % N == 0:
-            outfile.write(line)
+
+class TimeSampler:
+    """
+    Keeps, for every multiple of interval up to the time limit, the last line at
+    or before it and the first line after it (by search_time). The nearest
+    snapshot to such a time is always one of these two, so with an interval of
+    36s the extractor picks the same snapshot at every half percent as it would
+    from the full output. The first line (which holds the wall time in NORMAL
+    outputs), the last statistics line and the last line are kept as well.
+    """
+
+    def __init__(self, interval, time_limit=TIME_LIMIT):
+        self.interval = interval
+        self.time_limit = time_limit
+        self._boundary = interval
+        self._previous = None
+        self._last_statistics = None
+        self._last = None
+        self._written = -1
+
+    def _keep(self, index, line):
+        if index > self._written:
+            self._written = index
+            return [line]
+        return []
+
+    def push(self, index, line) -> list[str]:
+        """
+        Feed the next line. Returns the lines to write, in order.
+        """
+        kept = self._keep(index, line) if index == 0 else []
+        self._last = (index, line)
+
+        search_time = search_time_of(line)
+        if search_time is None:
+            if '"statistics"' in line:
+                self._last_statistics = (index, line)
+            return kept
+        self._last_statistics = (index, line)
+
+        if self._boundary < self.time_limit and search_time > self._boundary:
+            if self._previous is not None:
+                kept += self._keep(*self._previous)
+            kept += self._keep(index, line)
+            while self._boundary < search_time:
+                self._boundary += self.interval
+
+        self._previous = (index, line)
+        return kept
+
+    def finish(self) -> list[str]:
+        kept = []
+        for last in (self._last_statistics, self._last):
+            if last is not None:
+                kept += self._keep(*last)
+        return kept
+
+
+def sample_lines(lines, N=100, interval=None, time_limit=TIME_LIMIT):
+    """
+    Every Nth line, or with an interval (in seconds of search_time) the lines
+    TimeSampler keeps.
+    """
+    if interval is None:
+        for i, line in enumerate(lines):
+            if i % N == 0:
+                yield line
+    else:
+        sampler = TimeSampler(interval, time_limit)
+        for i, line in enumerate(lines):
+            yield from sampler.push(i, line)
+        yield from sampler.finish()
+
+
+def save_output(lines, outfile_path, N=100, interval=None, time_limit=TIME_LIMIT, compress=False, format="json"):
+    """
+    Writes the lines sample_lines keeps. With compress the file is gzipped, under
+    the same name. The binary format writes a solver_trace.py trace instead (block
+    compressed with compress).
+    """
+    outfile_path = Path(outfile_path)
+    outfile_path.parent.mkdir(exist_ok=True, parents=True)
+    lines = sample_lines(lines, N, interval, time_limit)
+
+    if format == "binary":
+        # Only the binary format needs numpy, the json output runs on a bare python
+        from solver_trace import TraceWriter
+
+        with TraceWriter(outfile_path, compression="auto" if compress else "none") as writer:
+            for line in lines:
+                if line.strip():
+                    writer.write_line(line)
+        return
+
+    if compress:
+        outfile = io.TextIOWrapper(io.BufferedWriter(gzip.GzipFile(outfile_path, 'wb'), WRITE_BUFFER_SIZE),
+                                   encoding='utf-8')
+    else:
+        outfile = open(outfile_path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+
+    with outfile:
+        outfile.writelines(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("outfile_path", type=Path)
+    parser.add_argument("--N", type=int,
+        help="Write every N lines", default=100)
+    parser.add_argument("--mode", choices=["every", "time"], default="every",
+        help="Keep every Nth line, or the lines around every --interval seconds of search_time")
+    parser.add_argument("--interval", type=float, default=TIME_LIMIT / 200,
+        help="Seconds of search_time between the kept snapshots in time mode (default: half a percent)")
+    parser.add_argument("--compress", action="store_true",
+        help="Gzip the output, or block compress a binary trace (the feature extraction reads either)")
+    parser.add_argument("--format", choices=["json", "binary"], default="json",
+        help="Write the json-stream lines, or a binary trace (see solver_trace.py)")
+    args = parser.parse_args()
+
+    save_output(sys.stdin, args.outfile_path, args.N,
+                interval=args.interval if args.mode == "time" else None, compress=args.compress, format=args.format)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Solves a batch of compiled problems in one long-lived process, instead of one
+Snakemake job (and container) per problem and solver.
+
+Every problem is solved with both chuffed variants, exactly as the
+solve_problem_*_chuffed rules do, and its output is saved through
+save_solver_output. Each run still gets its own output file, stderr log and
+benchmark TSV. Problems are assigned to batches round-robin over the sorted
+file names, and problems whose outputs already exist are skipped, so a batch
+can be restarted.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from save_solver_output import save_output
+
+SOLVERS = {
+    "NORMAL": "org.chuffed.chuffed",
+    "STATS": "org.chuffed.modded-chuffed",
+}
+TIME_LIMIT_MS = 7200000
+BENCHMARK_HEADER = "s\th:m:s\tmax_rss\tmax_vms\tmax_uss\tmax_pss\tio_in\tio_out\tmean_load\tcpu_time\n"
+
+
+def solver_command(fzn: Path, variant, time_limit=TIME_LIMIT_MS):
+    return ["minizinc", str(fzn), "--solver", SOLVERS[variant], "-t", str(time_limit),
+            "--json-stream", "--output-time", "-r", "42"]
+
+
+def write_benchmark(benchmark_path: Path, seconds, rusage):
+    """
+    Writes a benchmark TSV in the same layout as Snakemake's benchmark directive.
+    """
+    benchmark_path.parent.mkdir(parents=True, exist_ok=True)
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, whole_seconds = divmod(remainder, 60)
+    max_rss = rusage.ru_maxrss / 1024  # kilobytes to megabytes
+    cpu_time = rusage.ru_utime + rusage.ru_stime
+    benchmark_path.write_text(
+        BENCHMARK_HEADER
+        + f"{seconds:.4f}\t{hours}:{minutes:02d}:{whole_seconds:02d}\t{max_rss:.2f}\t-\t-\t-\t-\t-\t-\t{cpu_time:.2f}\n"
+    )
+
+
+class SolverRun:
+    """
+    One solver process on one problem, with its output streamed through
+    save_output (with save_options, e.g. N or interval) on a background thread
+    while it runs.
+    """
+
+    def __init__(self, fzn: Path, variant, output_path: Path, stderr_path: Path, **save_options):
+        stderr_path.parent.mkdir(parents=True, exist_ok=True)
+        self.output_path = output_path
+        # Written under a temporary name, so an interrupted run is not mistaken for a finished one
+        self.partial_path = output_path.with_name(output_path.name + ".part")
+        self.first_line = threading.Event()
+        self.stopped = False
+        self.seconds = None
+        self.rusage = None
+
+        self.start = time.monotonic()
+        self._stderr = open(stderr_path, "w")
+        # In its own session, so stopping it also stops the solver started by minizinc
+        self.process = subprocess.Popen(solver_command(fzn, variant), stdout=subprocess.PIPE, stderr=self._stderr,
+                                        text=True, start_new_session=True)
+        self._writer = threading.Thread(target=save_output, args=(self._lines(), self.partial_path),
+                                        kwargs=save_options)
+        self._writer.start()
+
+    def _lines(self):
+        for line in self.process.stdout:
+            self.first_line.set()
+            yield line
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def poll(self, block=False):
+        """
+        Returns True once the process has exited.
+        """
+        if self.seconds is None:
+            # wait4 instead of wait, to get the resource usage of this run alone
+            pid, status, rusage = os.wait4(self.process.pid, 0 if block else os.WNOHANG)
+            if pid == 0:
+                return False
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+            self.seconds, self.rusage = self.elapsed(), rusage
+        return True
+
+    def stop(self):
+        if self.seconds is None and not self.stopped:
+            self.stopped = True
+            os.killpg(self.process.pid, signal.SIGTERM)
+
+    def finish(self, benchmark_path: Path):
+        self.poll(block=True)
+        self._writer.join()
+        self.process.stdout.close()
+        self._stderr.close()
+        os.replace(self.partial_path, self.output_path)
+        write_benchmark(benchmark_path, self.seconds, self.rusage)
+
+
+def solve(fzn: Path, variant, output_path: Path, benchmark_path: Path, stderr_path: Path, **save_options):
+    """
+    Runs one solver on one problem, streaming its output through save_output.
+    Returns the wall time in seconds.
+    """
+    run = SolverRun(fzn, variant, output_path, stderr_path, **save_options)
+    run.finish(benchmark_path)
+    return run.seconds
+
+
+def solve_pair(fzn: Path, paths, stats_slack=2.0, stats_horizon=TIME_LIMIT_MS / 1000, poll_interval=0.5,
+               **save_options):
+    """
+    Runs the NORMAL and STATS solvers on one problem side by side.
+
+    - Once NORMAL has finished after T seconds, STATS gets an adaptive cutoff of
+      stats_slack * T seconds; it never runs past stats_horizon seconds, the
+      last point the features are needed for.
+    - Once STATS has solved the problem (exited on its own), NORMAL is stopped as
+      soon as it has written its first line, which holds the wall time the
+      features are labelled with.
+
+    Problems neither solver solves still take two cores for the whole time limit
+    (2 x 7200s): NORMAL is only stopped once STATS has exited on its own, and STATS
+    runs up to stats_horizon while NORMAL is running.
+
+    paths maps each variant to its (output, benchmark, stderr) paths. Returns
+    the SolverRun of each variant.
+    """
+    runs = {variant: SolverRun(fzn, variant, paths[variant][0], paths[variant][2], **save_options)
+            for variant in SOLVERS}
+    normal, stats = runs["NORMAL"], runs["STATS"]
+
+    while not (normal.poll() and stats.poll()):
+        stats_cutoff = stats_horizon
+        if normal.poll():
+            stats_cutoff = min(stats_cutoff, max(stats_slack * normal.seconds, poll_interval))
+        if stats.elapsed() >= stats_cutoff:
+            stats.stop()
+
+        if stats.poll() and not stats.stopped and normal.first_line.is_set():
+            normal.stop()
+
+        time.sleep(poll_interval)
+
+    for variant, run in runs.items():
+        run.finish(paths[variant][1])
+    return runs
+
+
+def problems_in_batch(input_dir: Path, batch, batches):
+    return sorted(input_dir.glob("*.fzn"))[batch::batches]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solve a batch of compiled problems with both chuffed variants")
+    parser.add_argument("input_dir", type=Path, help="Directory with the compiled .fzn problems")
+    parser.add_argument("output_dir", type=Path, help="Directory to write the solver outputs to")
+    parser.add_argument("--batch", type=int, required=True, help="Index of this batch")
+    parser.add_argument("--batches", type=int, required=True, help="Total number of batches")
+    parser.add_argument("--benchmark_dir", type=Path, required=True, help="Directory for the benchmark TSVs")
+    parser.add_argument("--log_dir", type=Path, required=True, help="Directory for the solver stderr logs")
+    parser.add_argument("--done", type=Path, help="File to list the written outputs in when the batch is done")
+    parser.add_argument("--N", type=int, default=100, help="Write every N lines of solver output")
+    parser.add_argument("--paired", action="store_true",
+                        help="Run NORMAL and STATS side by side with early termination (see solve_pair)")
+    parser.add_argument("--stats_slack", type=float, default=2.0,
+                        help="In paired mode, STATS may run this many times the NORMAL wall time")
+    parser.add_argument("--stats_horizon", type=float, default=TIME_LIMIT_MS / 1000,
+                        help="In paired mode, the longest STATS may run, in seconds")
+    parser.add_argument("--mode", choices=["every", "time"], default="every",
+                        help="How the output is sampled, see save_solver_output.py")
+    parser.add_argument("--interval", type=float, default=TIME_LIMIT_MS / 1000 / 200,
+                        help="Seconds of search_time between the kept snapshots in time mode")
+    parser.add_argument("--compress", action="store_true", help="Gzip the outputs (block compress binary traces)")
+    parser.add_argument("--format", choices=["json", "binary"], default="json",
+                        help="Write json-stream lines or binary traces, see save_solver_output.py")
+    args = parser.parse_args()
+    save_options = dict(N=args.N, interval=args.interval if args.mode == "time" else None, compress=args.compress,
+                        format=args.format)
+
+    written = []
+    for fzn in problems_in_batch(args.input_dir, args.batch, args.batches):
+        paths = {}
+        for variant in SOLVERS:
+            name = f"{fzn.stem}-OUTPUT-{variant}"
+            paths[variant] = (args.output_dir / f"{name}.json", args.benchmark_dir / f"{name}.tsv",
+                              args.log_dir / f"{name}.log")
+        written.extend(str(output_path) for output_path, _, _ in paths.values())
+
+        if args.paired:
+            if all(output_path.exists() for output_path, _, _ in paths.values()):
+                continue
+            runs = solve_pair(fzn, paths, args.stats_slack, args.stats_horizon, **save_options)
+            print(fzn.stem + ": " + ", ".join(
+                f"{variant} {run.seconds:.1f}s{' (stopped)' if run.stopped else ''}" for variant, run in runs.items()
+            ), flush=True)
+            continue
+
+        for variant, (output_path, benchmark_path, stderr_path) in paths.items():
+            if not output_path.exists():
+                seconds = solve(fzn, variant, output_path, benchmark_path, stderr_path, **save_options)
+                print(f"{output_path.stem}: {seconds:.1f}s", flush=True)
+
+    if args.done:
+        args.done.parent.mkdir(parents=True, exist_ok=True)
+        args.done.write_text("\n".join(written) + "\n")
+
+
+if __name__ == "__main__":
+    main()
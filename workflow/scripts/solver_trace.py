@@ -0,0 +1,361 @@
+"""
+Compact binary format for solver outputs, as an alternative to json-stream lines
+that repeat the same statistics keys on every line.
+
+    MAGIC | header length (uint32) | header (JSON) | blocks ... | footer (JSON) | footer length (uint64) | MAGIC
+
+The header fixes the schema: the statistics keys of the first statistics line
+with a search_time, each stored as float64 (solvers print doubles as 0 at the
+start, so the first line does not tell the types). Integers are exact up to
+2**53, and a column that only held integers reads back as int. Every
+statistics line with exactly that schema becomes one packed row; rows are written in blocks that are
+optionally compressed (zstd or lz4 if installed, zlib otherwise). All other lines
+(solutions, status, statistics with other keys) are kept verbatim in the footer,
+with the row they precede, together with the offset of every block. So a trace
+converts back to the JSON lines without loss of values.
+
+Uncompressed traces are memory-mapped, so the search_time column can be searched
+(np.searchsorted) without reading the statistics. The feature extraction reads
+the *-NORMAL.json/*-STATS.json outputs and recognises traces by their magic, so
+outputs are converted under their own name (in place):
+
+    python solver_trace.py to-binary OUTPUT-STATS.json OUTPUT-STATS.json --compression auto
+    python solver_trace.py to-json OUTPUT-STATS.json OUTPUT-STATS.json
+"""
+import argparse
+import json
+import os
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b"DSTRACE1"
+VERSION = 1
+BLOCK_ROWS = 4096
+WRITE_BUFFER_SIZE = 1 << 20
+COMPRESSIONS = ("none", "zlib", "zstd", "lz4")
+MAX_EXACT_INT = 2 ** 53  # larger integers do not survive float64, their lines go to the footer
+
+
+def default_compression():
+    if zstandard is not None:
+        return "zstd"
+    if lz4 is not None:
+        return "lz4"
+    return "zlib"
+
+
+def compress(data: bytes, compression) -> bytes:
+    if compression == "none":
+        return data
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    if compression == "lz4":
+        return lz4.frame.compress(data)
+    return zlib.compress(data)
+
+
+def decompress(data: bytes, compression) -> bytes:
+    if compression == "none":
+        return data
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Reading this trace requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == "lz4":
+        if lz4 is None:
+            raise RuntimeError("Reading this trace requires the lz4 package")
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+
+def is_trace(path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _dtype(columns, types):
+    return np.dtype([(column, "<" + column_type) for column, column_type in zip(columns, types)])
+
+
+class TraceWriter:
+    """
+    Writes json-stream lines, one at a time, to a binary trace.
+    """
+
+    def __init__(self, path, compression="none", block_rows=BLOCK_ROWS):
+        if compression == "auto":
+            compression = default_compression()
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unsupported compression: {compression}")
+
+        self.compression = compression
+        self.block_rows = block_rows
+        self.columns = None
+        self.dtype = None
+        self.rows = 0
+        self.lines = []
+        self.blocks = []
+        self._floats = set()
+        self._pending = []
+        self._file = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+        self._file.write(MAGIC)
+
+    def _write_header(self, statistics):
+        self.columns = list(statistics)
+        types = ["f8"] * len(self.columns)
+        self.dtype = _dtype(self.columns, types)
+        header = json.dumps({"version": VERSION, "columns": self.columns, "types": types,
+                             "compression": self.compression}).encode()
+        self._file.write(struct.pack("<I", len(header)))
+        self._file.write(header)
+
+    def _as_row(self, line: str):
+        """
+        The row for a statistics line that fits the schema, otherwise None.
+        """
+        if '"statistics"' not in line:
+            return None
+        try:
+            output = json.loads(line)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(output, dict) or output.keys() != {"type", "statistics"}:
+            return None
+        statistics = output["statistics"]
+        if not isinstance(statistics, dict) or "search_time" not in statistics:
+            return None
+        if any(type(value) not in (int, float) for value in statistics.values()):
+            return None
+
+        if self.columns is None:
+            self._write_header(statistics)
+        if list(statistics) != self.columns:
+            return None
+        if any(type(value) is int and abs(value) > MAX_EXACT_INT for value in statistics.values()):
+            return None
+        self._floats.update(column for column, value in statistics.items() if type(value) is float)
+        return tuple(statistics.values())
+
+    def write_line(self, line: str):
+        row = self._as_row(line)
+        if row is None:
+            self.lines.append((self.rows + len(self._pending), line.rstrip("\n")))
+            return
+
+        self._pending.append(row)
+        if len(self._pending) >= self.block_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        data = compress(np.array(self._pending, dtype=self.dtype).tobytes(), self.compression)
+        self.blocks.append((self._file.tell(), len(data), len(self._pending)))
+        self._file.write(data)
+        self.rows += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        if self.columns is None:
+            self.columns, self.dtype = [], _dtype([], [])
+            header = json.dumps({"version": VERSION, "columns": [], "types": [],
+                                 "compression": self.compression}).encode()
+            self._file.write(struct.pack("<I", len(header)))
+            self._file.write(header)
+        self._flush()
+
+        integers = [column for column in self.columns if column not in self._floats]
+        footer = json.dumps({"rows": self.rows, "blocks": self.blocks, "lines": self.lines,
+                             "integers": integers}).encode()
+        self._file.write(footer)
+        self._file.write(struct.pack("<Q", len(footer)))
+        self._file.write(MAGIC)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SolverTrace:
+    """
+    Reads a binary trace. statistics is a structured array with one field per
+    statistics key, memory-mapped if the trace is uncompressed.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a solver trace")
+            header_length, = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_length))
+
+            f.seek(-len(MAGIC) - 8, 2)
+            footer_length, = struct.unpack("<Q", f.read(8))
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is truncated")
+            f.seek(-len(MAGIC) - 8 - footer_length, 2)
+            footer = json.loads(f.read(footer_length))
+
+        self.columns = header["columns"]
+        self.dtype = _dtype(self.columns, header["types"])
+        self.compression = header["compression"]
+        self.rows = footer["rows"]
+        self.blocks = footer["blocks"]
+        self.lines = footer["lines"]
+        # Traces written before every column was float64 have their integers in i8 columns
+        self.integers = set(footer.get("integers", []))
+        self._statistics = None
+
+    @property
+    def statistics(self) -> np.ndarray:
+        if self._statistics is None:
+            if not self.blocks:
+                self._statistics = np.empty(0, dtype=self.dtype)
+            elif self.compression == "none":
+                # Blocks are written back to back, so the rows are one contiguous array
+                self._statistics = np.memmap(self.path, dtype=self.dtype, mode="r",
+                                             offset=self.blocks[0][0], shape=(self.rows,))
+            else:
+                with open(self.path, "rb") as f:
+                    data = []
+                    for offset, length, _ in self.blocks:
+                        f.seek(offset)
+                        data.append(decompress(f.read(length), self.compression))
+                self._statistics = np.frombuffer(b"".join(data), dtype=self.dtype)
+        return self._statistics
+
+    @property
+    def search_time(self) -> np.ndarray:
+        if "search_time" not in self.columns:
+            return np.empty(0)
+        return self.statistics["search_time"]
+
+    def _as_statistics(self, row) -> dict:
+        return {column: int(value) if column in self.integers else value for column, value in zip(self.columns, row)}
+
+    def row(self, index) -> dict:
+        return self._as_statistics(self.statistics[index].tolist())
+
+    def rows_at(self, indices) -> list[dict]:
+        # tolist() converts all the values to Python scalars at once
+        return [self._as_statistics(row) for row in self.statistics[np.asarray(indices)].tolist()]
+
+    def footer_statistics(self) -> list[tuple[int, dict]]:
+        """
+        The statistics lines with a search_time that did not fit the schema (kept
+        verbatim in the footer), with the row they precede.
+        """
+        snapshots = []
+        for position, line in self.lines:
+            if '"search_time"' not in line:
+                continue
+            output = json.loads(line)
+            statistics = output.get("statistics") if isinstance(output, dict) else None
+            if isinstance(statistics, dict) and "search_time" in statistics:
+                snapshots.append((position, statistics))
+        return snapshots
+
+    def row_line(self, index) -> str:
+        return json.dumps({"type": "statistics", "statistics": self.row(index)})
+
+    def first_line(self):
+        """
+        The first line of the output (None if it was empty).
+        """
+        if self.lines and self.lines[0][0] == 0:
+            return self.lines[0][1]
+        return self.row_line(0) if self.rows else None
+
+    def last_statistics(self):
+        """
+        The statistics of the last line of the output (None if it has none), like
+        HalfPercentSampler.final_statistic.
+        """
+        for position, line in reversed(self.lines):
+            if position < self.rows:
+                break
+            if line.strip():
+                return json.loads(line).get("statistics")
+        return self.row(self.rows - 1) if self.rows else None
+
+    def iter_lines(self):
+        """
+        The output as json-stream lines again (without line endings).
+        """
+        lines = iter(self.lines)
+        extra = next(lines, None)
+        for index in range(self.rows + 1):
+            while extra is not None and extra[0] == index:
+                yield extra[1]
+                extra = next(lines, None)
+            if index < self.rows:
+                yield self.row_line(index)
+
+
+def _part_path(path) -> Path:
+    path = Path(path)
+    return path.with_name(path.name + ".part")
+
+
+def to_binary(json_path, trace_path, compression="auto"):
+    """
+    Converts json-stream lines to a trace. The trace is written under a temporary
+    name and moved in place, so trace_path may be json_path itself.
+    """
+    part_path = _part_path(trace_path)
+    with open(json_path, "r", encoding="utf-8") as lines, TraceWriter(part_path, compression) as writer:
+        for line in lines:
+            if line.strip():
+                writer.write_line(line)
+    os.replace(part_path, trace_path)
+
+
+def to_json(trace_path, json_path):
+    """
+    Converts a trace back to json-stream lines, like to_binary safe to do in place.
+    """
+    part_path = _part_path(json_path)
+    with open(part_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+        for line in SolverTrace(trace_path).iter_lines():
+            f.write(line + "\n")
+    os.replace(part_path, json_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert solver outputs between json-stream lines and binary traces")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    binary = subparsers.add_parser("to-binary", help="Convert a json-stream output to a binary trace")
+    binary.add_argument("input", type=Path)
+    binary.add_argument("output", type=Path, help="May be the input, to convert it in place")
+    binary.add_argument("--compression", choices=("auto",) + COMPRESSIONS, default="auto",
+                        help="Block compression (auto: zstd, lz4 or zlib, whichever is installed)")
+    to_lines = subparsers.add_parser("to-json", help="Convert a binary trace back to json-stream lines")
+    to_lines.add_argument("input", type=Path)
+    to_lines.add_argument("output", type=Path, help="May be the input, to convert it in place")
+    args = parser.parse_args()
+
+    if args.command == "to-binary":
+        to_binary(args.input, args.output, args.compression)
+    else:
+        to_json(args.input, args.output)
+
+
+if __name__ == "__main__":
+    main()